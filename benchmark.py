@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import json
+import uuid
+import shutil
+import argparse
+import tempfile
+import collections
+import numpy as np
+import drdf
+import merge
+import fast_resp
+
+def synthetic_block(config, nevents, ncameras=76, occupancy=0.1, photons=5., miss=0.1, start=0, seed=0):
+    """events [start, start+nevents) in the format of fast_resp.load_block.
+       In each camera a fraction occupancy of the channels is hit, on average by photons photons;
+       a fraction miss of the photons does not reach the sensor plane"""
+    rng = np.random.default_rng(seed)
+    shape = config['matrix']
+    pitch = config['cellsize'] + 2 * config['celledge']
+    nch = shape[0] * shape[1]
+    cameras = collections.OrderedDict()
+    for j in range(ncameras):
+        columns = []
+        sizes = np.zeros(nevents, dtype=np.int64)
+        for i in range(nevents):
+            hit = rng.choice(nch, size=rng.binomial(nch, occupancy), replace=False)
+            ch = np.repeat(hit, 1 + rng.poisson(photons - 1, hit.size))          #at least one photon in each hit channel
+            jitter = rng.uniform(-config['cellsize'] / 2, config['cellsize'] / 2, (2, ch.size))
+            x = (ch % shape[0] - shape[0] / 2 + 0.5) * pitch + jitter[0]             #inverse of the channel of assign_channel
+            y = -((ch // shape[0] - shape[1] / 2 + 0.5) * pitch + jitter[1])
+            z = np.where(rng.random(ch.size) < miss, config['zplane'] + 1., config['zplane'])
+            t = rng.exponential(config['integrTime'] / 2, ch.size)
+            columns.append(np.stack((t, x, y, z)))
+            sizes[i] = ch.size
+        offsets = np.zeros(nevents + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        cameras['CAM_%02d' % j] = (np.hstack(columns), offsets)
+    return {'start': start, 'stop': start + nevents, 'idEvent': np.arange(start, start + nevents, dtype=np.int32),
+            'cameras': cameras}
+
+def block_photons(block):
+    return sum(int(offsets[-1]) for columns, offsets in block['cameras'].values())
+
+def write_sensors_root(fname, block):
+    """writes the block as a small sensors.root, with one tree of photons per camera"""
+    ROOT = fast_resp.ROOT
+    if ROOT is None:
+        sys.exit('ROOT is needed to write ' + fname)
+    outFile = ROOT.TFile(fname, 'RECREATE')
+    ROOT.TNamed('DUMMY', 'commit hash of the geometry').Write('commit_hash')
+    for name, (columns, offsets) in block['cameras'].items():
+        tree = ROOT.TTree(name, name)
+        idEvent = np.zeros(1, dtype=np.int32)
+        tree.Branch('idEvent', idEvent, 'idEvent/I')
+        vectors = [ROOT.std.vector('double')() for branch in fast_resp.SENSOR_BRANCHES]
+        for branch, vector in zip(fast_resp.SENSOR_BRANCHES, vectors):
+            tree.Branch(branch, vector)
+        for i in range(len(offsets) - 1):
+            idEvent[0] = block['idEvent'][i]
+            for row, vector in zip(columns[:, offsets[i]:offsets[i + 1]], vectors):
+                vector.clear()
+                for value in row:
+                    vector.push_back(value)
+            tree.Fill()
+        tree.Write()
+    outFile.Close()
+
+def best_time(function, repeat):
+    """shortest of repeat runs of function, in seconds"""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def event_photons(block, config):
+    """(time, channel, ncam) of every event, as fast_resp.event_tensor gets them"""
+    events = []
+    for evn in range(block['start'], block['stop']):
+        photons, cam, cameras = fast_resp.load_event_data(block, [evn])
+        t_arr, ch = fast_resp.assign_channel(photons, config, cam=cam)
+        events.append((t_arr, ch, len(cameras)))
+    return events
+
+def sampling_check(config, photons=(1, 5, 50, 500), trials=20000, seed=0):
+    """compares the channel amplitudes of sipm_response drawn per photon and per channel, for channels with the given
+       photons: mean and variance (z-scores) and two-sample Kolmogorov-Smirnov distance; returns True if they agree"""
+    rng = np.random.default_rng(seed)
+    ks_critical = 1.95 * np.sqrt(2 / trials)               #significance 0.001
+    agree = True
+    for n in photons:
+        t_num = np.full(trials, n)
+        a = fast_resp.sipm_response(t_num, rng, dict(config, sampling='photon'))
+        b = fast_resp.sipm_response(t_num, rng, dict(config, sampling='channel'))
+        z_mean = (a.mean() - b.mean()) / np.sqrt((a.var() + b.var()) / trials)
+        var_error = np.sqrt((np.mean((a - a.mean())**4) - a.var()**2 + np.mean((b - b.mean())**4) - b.var()**2) / trials)
+        z_var = (a.var() - b.var()) / var_error if var_error > 0 else 0.
+        a.sort()
+        b.sort()
+        both = np.concatenate((a, b))
+        ks = np.max(np.abs(np.searchsorted(a, both, 'right') - np.searchsorted(b, both, 'right'))) / trials
+        ok = abs(z_mean) < 4 and abs(z_var) < 4 and ks < ks_critical
+        agree = agree and ok
+        print('%5d photons: mean %8.3f / %8.3f (z %+5.2f)  variance %8.3f / %8.3f (z %+5.2f)  KS %.4f (critical %.4f)  %s'
+              % (n, a.mean(), b.mean(), z_mean, a.var(), b.var(), z_var, ks, ks_critical, 'ok' if ok else 'DIFFERENT'))
+    return agree
+
+def run_benchmarks(block, config, workdir, names=None, repeat=3, batch=1, shards=4):
+    """runs the benchmarks on block; returns name -> events/s, photons/s, MB/s"""
+    nevents = block['stop'] - block['start']
+    nphotons = block_photons(block)
+    fast_resp.CONFIG = config                       #globals of the fast_resp processes, see init_worker
+    fast_resp.args = argparse.Namespace(nocut=False, batch=batch)
+    fast_resp.runid = uuid.UUID(int=0)
+    fast_resp.RUNS = [(fast_resp.runid, config)]
+    results = collections.OrderedDict()
+
+    def report(name, seconds, nbytes=None):
+        results[name] = {'events/s': nevents / seconds, 'photons/s': nphotons / seconds}
+        if nbytes is not None:
+            results[name]['MB/s'] = nbytes / seconds / 1e6
+        print('%-22s %9.3f s %12.1f events/s %14.0f photons/s' % (name, seconds, nevents / seconds, nphotons / seconds)
+              + ('' if nbytes is None else ' %9.1f MB/s' % results[name]['MB/s']))
+
+    def wanted(name):
+        return names is None or name in names
+
+    if wanted('assign_channel'):
+        cameras = [(columns[:, offsets[i]:offsets[i + 1]].T) for columns, offsets in block['cameras'].values()
+                   for i in range(nevents)]
+        buf = {}
+        report('assign_channel', best_time(lambda: [fast_resp.assign_channel(photons, config, buf=buf) for photons in cameras], repeat))
+    if wanted('count_photons') or wanted('count_photons_channel') or wanted('count_photons_no_cut'):
+        events = event_photons(block, config)
+        out = fast_resp.new_image(config, ncam=events[0][2]) if events else None
+        if wanted('count_photons'):
+            rngs = [np.random.default_rng(k) for k in range(len(block['cameras']))]
+            report('count_photons', best_time(lambda: [fast_resp.count_photons(t, ch, config, out, ncam, rngs) for t, ch, ncam in events], repeat))
+        if wanted('count_photons_channel'):                    #sampling per channel, see sipm_response_channel
+            rngs = [np.random.default_rng(k) for k in range(len(block['cameras']))]
+            channel = dict(config, sampling='channel')
+            report('count_photons_channel', best_time(lambda: [fast_resp.count_photons(t, ch, channel, out, ncam, rngs) for t, ch, ncam in events], repeat))
+        if wanted('count_photons_no_cut'):
+            report('count_photons_no_cut', best_time(lambda: [fast_resp.count_photons_no_cut(t, ch, config, out, ncam) for t, ch, ncam in events], repeat))
+    def response():
+        images = []
+        for evn in range(block['start'], block['stop'], batch):
+            img, cameras = fast_resp.main_evn(block, range(evn, min(evn + batch, block['stop'])))
+            images.append(img[0])
+        return cameras, np.concatenate(images)
+    if wanted('main_evn'):
+        report('main_evn', best_time(response, repeat))
+    if not (wanted('drdf_write') or wanted('drdf_read') or wanted('merge')):
+        return results
+
+    cameras, images = response()
+    data = drdf.DRDF()
+    data.start_run(fast_resp.runid)
+    data.set_georef("DUMMY")
+    for i, idEvent in enumerate(block['idEvent']):
+        data.start_event(int(idEvent))
+        for camera, img in zip(cameras, images[i]):
+            data.add_image(camera, drdf.Image(img))
+    fname = os.path.join(workdir, 'response.drdf')
+    write = lambda: data.write(fname)
+    if wanted('drdf_write'):
+        seconds = best_time(write, repeat)
+        report('drdf_write', seconds, os.path.getsize(fname))
+    else:
+        write()
+    if wanted('drdf_read'):
+        report('drdf_read', best_time(lambda: drdf.DRDF().read(fname), repeat), os.path.getsize(fname))
+    if wanted('merge'):
+        paths = []
+        for k, part in enumerate(np.array_split(np.arange(nevents), shards)):          #the events of each job
+            paths.append(merge.shard_path(workdir, k))
+            with drdf.DRDFWriter(paths[-1]) as f:
+                f.start_run(fast_resp.runid)
+                f.set_georef("DUMMY")
+                for i in part:
+                    f.start_event(int(block['idEvent'][i]))
+                    for camera, img in zip(cameras, images[i]):
+                        f.add_image(camera, drdf.Image(img))
+        output = os.path.join(workdir, 'merged.drdf')
+        report('merge', best_time(lambda: merge.merge(paths, output), repeat), sum(os.path.getsize(p) for p in paths))
+    return results
+
+def compare(results, baseline, tolerance):
+    """names of the rates which are more than tolerance (a fraction) below the baseline"""
+    regressions = []
+    for name, rates in results.items():
+        for unit, rate in rates.items():
+            reference = baseline.get(name, {}).get(unit)
+            if reference and rate < reference * (1 - tolerance):
+                print('REGRESSION %s: %.4g %s, baseline %.4g (%+.0f%%)' % (name, rate, unit, reference, 100 * (rate / reference - 1)))
+                regressions.append(name)
+    return regressions
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks of the detector response on synthetic events')
+    parser.add_argument('-c', '--config', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.xml'), help = ' configuration .xml file (default: config.xml)')
+    parser.add_argument('-e', '--events', type=int, default=100, help = ' number of synthetic events')
+    parser.add_argument('--cameras', type=int, default=76, help = ' cameras per event')
+    parser.add_argument('--occupancy', type=float, default=0.1, help = ' fraction of hit channels of each camera')
+    parser.add_argument('--photons', type=float, default=5., help = ' mean photons per hit channel')
+    parser.add_argument('--seed', type=int, default=0, help = ' seed of the synthetic events')
+    parser.add_argument('-b', '--batch', type=int, default=1, help = ' events processed together by main_evn')
+    parser.add_argument('--shards', type=int, default=4, help = ' files merged by the merge benchmark')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help = ' runs of each benchmark, the fastest is reported')
+    parser.add_argument('--only', nargs='+', metavar='NAME', help = ' run only these benchmarks')
+    parser.add_argument('--save', metavar='FILE', help = ' store the results as baseline in FILE')
+    parser.add_argument('--compare', metavar='FILE', help = ' compare the results with the baseline in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.15, help = ' slowdown wrt the baseline reported as regression (default: 0.15)')
+    parser.add_argument('--check-sampling', action='store_true', help = ' only check that the per photon and per channel sampling of the SiPM response agree')
+    parser.add_argument('--sensors-root', metavar='FILE', help = ' only write the synthetic events to FILE, in the sensors.root format (needs ROOT)')
+    args = parser.parse_args()
+
+    config = fast_resp.import_configuration(args.config)
+    if args.check_sampling:
+        sys.exit(0 if sampling_check(config) else 1)
+    params = {'events': args.events, 'cameras': args.cameras, 'occupancy': args.occupancy, 'photons': args.photons,
+              'seed': args.seed, 'batch': args.batch, 'shards': args.shards}
+    block = synthetic_block(config, args.events, args.cameras, args.occupancy, args.photons, seed=args.seed)
+    if args.sensors_root:
+        write_sensors_root(args.sensors_root, block)
+        print('Written', args.events, 'events with', block_photons(block), 'photons to', args.sensors_root)
+        sys.exit()
+
+    print('Synthetic input:', args.events, 'events,', args.cameras, 'cameras,', block_photons(block), 'photons')
+    workdir = tempfile.mkdtemp(prefix='fast_resp_bench')
+    try:
+        results = run_benchmarks(block, config, workdir, args.only, args.repeat, args.batch, args.shards)
+    finally:
+        shutil.rmtree(workdir)
+
+    status = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['params'] != params:
+            print('WARNING: the baseline was measured with', baseline['params'])
+        if compare(results, baseline['results'], args.tolerance):
+            status = 1
+        else:
+            print('No regressions wrt', args.compare)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2)
+    sys.exit(status)
@@ -17,24 +17,96 @@
 
 from binascii import crc32
 import collections
+import lzma
+import mmap
 import numpy
+import os
 import struct
+import threading
 import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
 
+# compiled wrapper of libdrdf, built by setup.py when possible: DRDF.read and DRDF.write use it
+# if it can be imported (set drdf._libdrdf = None to use pure Python)
+try:
+  from . import _libdrdf
+except ImportError:
+  try:
+    import _libdrdf
+  except ImportError:
+    _libdrdf = None
+
 class Fmtcode(IntEnum):
     Au8 = 0
     Au8Tu8 = 1
     Au16 = 2
     Au16Tu16 = 3
     Af32Tf32 = 4
+    SparseAf32Tf32 = 5
+
+# SparseAf32Tf32 stores only the non-empty pixels of an Af32Tf32 image,
+# as (index in the flattened image, amplitude, time) records
+_sparse_dtype = numpy.dtype([('index', '<u4'), ('amplitude', '<f4'), ('time', '<f4')])
+
+# images with a smaller fraction of non-empty pixels are written as SparseAf32Tf32
+SPARSE_DENSITY = 0.5
+
+class Codec(IntEnum):
+    Zlib = 1
+    Lzma = 2
+
+# a ZDAT chunk replaces an IDAT, a ZEVT chunk holds all the ISRC/IFMT/IDAT chunks of an event:
+# both start with the codec and the uncompressed length, followed by the compressed bytes
+_zhead = struct.Struct('<BxxxI')
+
+def _compress(codec, buf):
+  if codec == Codec.Zlib:
+    payload = zlib.compress(buf)
+  elif codec == Codec.Lzma:
+    payload = lzma.compress(buf)
+  else:
+    raise TypeError('Invalid codec: {0}'.format(codec))
+  return _zhead.pack(codec, len(buf)) + payload
+
+def _decompress(buf):
+  if len(buf) < _zhead.size:
+    raise IOError('Compressed chunk is too short')
+  codec, length = _zhead.unpack_from(buf, 0)
+  if codec == Codec.Zlib:
+    data = zlib.decompress(buf[_zhead.size:])
+  elif codec == Codec.Lzma:
+    data = lzma.decompress(buf[_zhead.size:])
+  else:
+    raise IOError('Invalid codec: {0}'.format(codec))
+  if len(data) != length:
+    raise IOError('Decompressed chunk has invalid length')
+  return data
+
+def _inner_chunks(buf):
+  pos = 0
+  while pos < len(buf):
+    length, tag = struct.unpack_from('<I4s', buf, pos)
+    pos += 8
+    if pos + length > len(buf):
+      raise IOError('Chunk exceeds compressed block')
+    yield tag, pos, length
+    pos += length
+
+def _shift_entry(entry, shift):
+  # image entries are (offset, length, x, y, fmt, block offset, block length),
+  # offset is in the file, or in the decompressed block if block length is not 0
+  if entry[6]:
+    return entry[:5] + (entry[5] + shift, entry[6])
+  return (entry[0] + shift,) + entry[1:]
 
 def _decode_fmt(x, y, fmt):
   if fmt == Fmtcode.Au8 or fmt == Fmtcode.Au8Tu8:
     dtype = numpy.uint8
   elif fmt == Fmtcode.Au16 or fmt == Fmtcode.Au16Tu16:
     dtype = numpy.uint16
-  elif fmt == Fmtcode.Af32Tf32:
+  elif fmt == Fmtcode.Af32Tf32 or fmt == Fmtcode.SparseAf32Tf32:
     dtype = numpy.float32
   else:
     raise TypeError('Invalid Format: {0}'.format(fmt))
@@ -44,7 +116,11 @@ def _decode_fmt(x, y, fmt):
     shape = (x, y, 2)
   return shape, dtype
 
-def _encode_fmt(shape, dtype):
+def _encode_fmt(shape, dtype, sparse=False):
+  if sparse:
+    if len(shape) == 3 and shape[2] == 2 and dtype == numpy.float32:
+      return shape[0], shape[1], Fmtcode.SparseAf32Tf32
+    raise TypeError('Sparse images must be Af32Tf32, got {0} {1}'.format(shape, dtype))
   if len(shape) == 2:
     if dtype == numpy.uint8:
       fmtcode = Fmtcode.Au8
@@ -65,6 +141,19 @@ def _encode_fmt(shape, dtype):
       raise TypeError('Invalid shape: {0}'.format(shape))
   return shape[0], shape[1], fmtcode
 
+def _sparse_to_dense(x, y, rawbytes):
+  if len(rawbytes) % _sparse_dtype.itemsize:
+    raise IOError('Sparse image data has invalid length: {0}'.format(len(rawbytes)))
+  records = numpy.frombuffer(rawbytes, dtype=_sparse_dtype)
+  if len(records) and records['index'].max() >= x * y:
+    raise IOError('Sparse image index out of range')
+  pixels = numpy.zeros(shape=(x, y, 2), dtype=numpy.float32, order='C')
+  pixels[..., 1] = numpy.nan
+  flat = pixels.reshape(-1, 2)
+  flat[records['index'], 0] = records['amplitude']
+  flat[records['index'], 1] = records['time']
+  return pixels
+
 class Image:
 
   def __init__(self, w, h=None, fmt=None, rawbytes=None):
@@ -76,7 +165,10 @@ class Image:
       self.height = h
       self.fmtcode = fmt
       shape, dtype = _decode_fmt(w, h, fmt)
-      if rawbytes is None:
+      if fmt == Fmtcode.SparseAf32Tf32:
+        self.fmtcode = Fmtcode.Af32Tf32
+        self.pixels = _sparse_to_dense(w, h, bytes() if rawbytes is None else rawbytes)
+      elif rawbytes is None:
         self.pixels = numpy.zeros(shape=shape, dtype=dtype, order='C')
       else:
         self.pixels = numpy.frombuffer(rawbytes, dtype=dtype)
@@ -85,6 +177,20 @@ class Image:
   def bytes(self):
     return self.pixels.tobytes()
 
+  def buffer(self):
+    return memoryview(numpy.ascontiguousarray(self.pixels)).cast('B')
+
+  def sparse(self):
+    if self.fmtcode != Fmtcode.Af32Tf32:
+      raise TypeError('Only Af32Tf32 images can be made sparse')
+    flat = self.pixels.reshape(-1, 2)
+    index = numpy.flatnonzero((flat[:, 0] != 0) | ~numpy.isnan(flat[:, 1]))
+    records = numpy.empty(len(index), dtype=_sparse_dtype)
+    records['index'] = index
+    records['amplitude'] = flat[index, 0]
+    records['time'] = flat[index, 1]
+    return records
+
 def _write_chunk(f, tag, buf, crc):
   head = struct.pack('<I4s', len(buf), tag)
   crc = crc32(head, crc)
@@ -112,6 +218,80 @@ def _read_chunk(f, crc):
     crc = crc32(body, crc)
   return tag, body, crc
 
+def _index_fname(fname):
+  return fname + '.idx'
+
+def _file_signature(fname):
+  with open(fname, mode='rb') as f:
+    size = f.seek(0, os.SEEK_END)
+    if size < 20:
+      return size, None
+    f.seek(size - 12)
+    length, tag, crc = struct.unpack('<I4sI', f.read(12))
+  return size, crc if tag == b'ERAW' else None
+
+def write_index(fname, reader=None):
+  if reader is None:
+    with DRDFReader(fname, index=False) as reader:
+      return write_index(fname, reader)
+  size, crc = _file_signature(fname)
+  runs = list(reader.runs)
+  parts = [struct.pack('<4sIQII', b'DRIX', 2, size, crc or 0, len(runs))]
+  for run_uuid in runs:
+    georef = bytes(reader.georefs.get(run_uuid, ''), 'ascii')
+    parts.append(struct.pack('<16sH', run_uuid.bytes, len(georef)) + georef)
+  events = [(i, event_id) for i, run_uuid in enumerate(runs) for event_id in reader.runs[run_uuid]]
+  parts.append(struct.pack('<I', len(events)))
+  for i, event_id in events:
+    eventdata = reader.runs[runs[i]][event_id]
+    start, end = reader.spans[(runs[i], event_id)]
+    parts.append(struct.pack('<IIQQI', i, event_id, start, end, len(eventdata)))
+    for src, (offset, length, x, y, fmt, block_offset, block_length) in eventdata.items():
+      source = bytes(src, 'ascii')
+      parts.append(struct.pack('<H', len(source)) + source
+                   + struct.pack('<HHBxxxQIQI', x, y, fmt, offset, length, block_offset, block_length))
+  with open(_index_fname(fname), mode='wb') as f:
+    f.write(b''.join(parts))
+
+def read_index(fname):
+  try:
+    with open(_index_fname(fname), mode='rb') as f:
+      buf = f.read()
+    magic, version, size, crc, nruns = struct.unpack_from('<4sIQII', buf, 0)
+    if magic != b'DRIX' or version != 2 or (size, crc) != _file_signature(fname):
+      return None
+    pos = 24
+    runs = []
+    georefs = {}
+    for i in range(nruns):
+      run_bytes, length = struct.unpack_from('<16sH', buf, pos)
+      runs.append(uuid.UUID(bytes=run_bytes))
+      georefs[runs[-1]] = buf[pos + 18:pos + 18 + length].decode('ascii')
+      pos += 18 + length
+    index = collections.OrderedDict((run_uuid, collections.OrderedDict()) for run_uuid in runs)
+    spans = {}
+    nevents, = struct.unpack_from('<I', buf, pos)
+    pos += 4
+    for i in range(nevents):
+      run, event_id, start, end, nimages = struct.unpack_from('<IIQQI', buf, pos)
+      if run >= nruns or start > end or end > size:
+        return None
+      pos += 28
+      eventdata = index[runs[run]].setdefault(event_id, collections.OrderedDict())
+      spans[(runs[run], event_id)] = [start, end]
+      for j in range(nimages):
+        length, = struct.unpack_from('<H', buf, pos)
+        src = buf[pos + 2:pos + 2 + length].decode('ascii')
+        x, y, fmt, offset, datalen, block_offset, block_length = struct.unpack_from('<HHBxxxQIQI', buf, pos + 2 + length)
+        # compressed images are located in their decompressed block, the block itself in the file
+        if (block_offset + block_length if block_length else offset + datalen) > size:
+          return None
+        eventdata[src] = (offset, datalen, x, y, fmt, block_offset, block_length)
+        pos += 34 + length
+  except (OSError, struct.error, UnicodeDecodeError, IndexError, ValueError):
+    return None
+  return index, georefs, spans
+
 class DRDF:
 
   def __init__(self):
@@ -132,7 +312,11 @@ class DRDF:
   def add_image(self, source, image):
     self.current_event[source] = image
 
-  def read(self, fname):
+  def read(self, fname, events=None):
+    if events is not None:
+      return self._read_events(fname, events)
+    if _libdrdf is not None:
+      return self._read_native(fname)
     with open(fname, mode='rb') as f:
       crc = 0xFFFFFFFF
       buf = f.read(8)
@@ -156,27 +340,378 @@ class DRDF:
           evnum = struct.unpack('<I', chunk_data)[0]
           self.start_event(evnum)
         elif current_chunk == b'IFMT':
-          current_shape, current_dtype = _decode_fmt(*struct.unpack('<HHBxxx', chunk_data))
+          current_fmt = struct.unpack('<HHBxxx', chunk_data)
         elif current_chunk == b'ISRC':
           current_source = chunk_data.decode('ascii')
         elif current_chunk == b'IDAT':
-          pixels = numpy.frombuffer(chunk_data, dtype=current_dtype)
-          self.add_image(current_source, Image(numpy.reshape(pixels, current_shape, order='C')))
+          self.add_image(current_source, Image(*current_fmt, rawbytes=chunk_data))
+        elif current_chunk == b'ZDAT':
+          self.add_image(current_source, Image(*current_fmt, rawbytes=_decompress(chunk_data)))
+        elif current_chunk == b'ZEVT':
+          block = _decompress(chunk_data)
+          for tag, pos, length in _inner_chunks(block):
+            if tag == b'IFMT':
+              current_fmt = struct.unpack_from('<HHBxxx', block, pos)
+            elif tag == b'ISRC':
+              current_source = block[pos:pos + length].decode('ascii')
+            elif tag == b'IDAT':
+              self.add_image(current_source, Image(*current_fmt, rawbytes=block[pos:pos + length]))
+
+  def _read_native(self, fname):
+    # the pixels stay in the buffers filled by libdrdf, numpy only views them
+    for run_bytes, georef, rundata in _libdrdf.read(fname):
+      self.start_run(uuid.UUID(bytes=run_bytes))
+      if georef is not None:
+        self.set_georef(georef)
+      for event_id, eventdata in rundata:
+        self.start_event(event_id)
+        for source, x, y, fmt, pixels in eventdata:
+          self.add_image(source, Image(x, y, fmt, rawbytes=pixels))
 
-  def write(self, fname):
-    crc = 0xFFFFFFFF
-    with open(fname, mode='wb') as f:
-      crc = _write_chunk(f, b'HRAW', bytes(), crc);
+  def _read_events(self, fname, events):
+    with DRDFReader(fname, verify=False) as reader:
+      for run_uuid, rundata in reader.runs.items():
+        self.start_run(run_uuid)
+        self.set_georef(reader.georefs.get(run_uuid, ''))
+        for event_id in events:
+          if event_id in rundata:
+            self.start_event(event_id)
+            for src, image in reader.event(event_id, run=run_uuid).items():
+              self.add_image(src, Image(image.pixels.copy()))
+
+  def write(self, fname, index=False, sparse=SPARSE_DENSITY, compress=None, group=False):
+    if _libdrdf is not None and compress is None and not group:
+      _libdrdf.write(fname, self.runs, sparse or 0)
+      if index:
+        write_index(fname)
+      return
+    with DRDFWriter(fname, index, sparse=sparse, compress=compress, group=group) as f:
       for run_uuid, rundata in self.runs.items():
-        crc = _write_chunk(f, b'RSTA', run_uuid.bytes, crc)
-        crc = _write_chunk(f, b'RGEO', bytes(rundata.georef, 'ascii'), crc)
+        f.start_run(run_uuid)
+        f.set_georef(rundata.georef)
         for event_id, eventdata in rundata.items():
-          crc = _write_chunk(f, b'EVNT', struct.pack('<I', event_id), crc)
+          f.start_event(event_id)
           for img_src, img in eventdata.items():
-            crc = _write_chunk(f, b'ISRC', bytes(img_src, 'ascii'), crc)
-            crc = _write_chunk(f, b'IFMT', struct.pack('<HHBxxx', img.width, img.height, img.fmtcode), crc)
-            crc = _write_chunk(f, b'IDAT', img.bytes(), crc)
-      end = b'\x04\0\0\0ERAW';
-      crc = crc32(end, crc);
-      crcbytes = struct.pack('<I', crc)
-      _write_chunk(f, b'ERAW', crcbytes, crc);
+            f.add_image(img_src, img)
+
+class DRDFWriter:
+
+  def __init__(self, fname, index=False, buffering=1<<20, resume=None, sparse=SPARSE_DENSITY,
+               compress=None, group=False):
+    self.fname = fname
+    self.sparse = sparse
+    # compress is a Codec for the image data, group stores all the images of an event in one block
+    self.compress = compress or (Codec.Zlib if group else None)
+    self.group = group
+    self.pending = []
+    self.pending_images = []
+    self.pending_len = 0
+    if resume is None:
+      self.file = open(fname, mode='wb', buffering=buffering)
+      self.crc = _write_chunk(self.file, b'HRAW', bytes(), 0xFFFFFFFF)
+      self.pos = 8
+    else:
+      # continue an unfinished file from a checkpoint() state, the chunks already in it are not indexed
+      self.pos, self.crc = resume
+      self.file = open(fname, mode='r+b', buffering=buffering)
+      self.file.truncate(self.pos)
+      self.file.seek(self.pos)
+      index = False
+    self.index = index
+    self.current_span = None
+    self.runs = collections.OrderedDict()
+    self.georefs = {}
+    self.spans = {}
+
+  def _chunk(self, tag, buf):
+    self.crc = _write_chunk(self.file, tag, buf, self.crc)
+    self.pos += 8 + len(buf)
+    if self.index and self.current_span is not None:
+      self.current_span[1] = self.pos
+
+  def _trailer(self):
+    end = b'\x04\0\0\0ERAW';
+    crc = crc32(end, self.crc);
+    crcbytes = struct.pack('<I', crc)
+    _write_chunk(self.file, b'ERAW', crcbytes, crc);
+
+  def _pending_chunk(self, tag, buf):
+    self.pending.append(struct.pack('<I4s', len(buf), tag))
+    self.pending.append(bytes(buf))
+    self.pending_len += 8 + len(buf)
+
+  def _flush_group(self):
+    if not self.pending:
+      return
+    block = _compress(self.compress, b''.join(self.pending))
+    for eventdata, source, entry in self.pending_images:
+      eventdata[source] = entry + (self.pos + 8, len(block))
+    self._chunk(b'ZEVT', block)
+    self.pending = []
+    self.pending_images = []
+    self.pending_len = 0
+
+  def start_run(self, run_uuid):
+    self._flush_group()
+    self.current_span = None
+    self._chunk(b'RSTA', run_uuid.bytes)
+    self.current_run = run_uuid
+    self.runs.setdefault(run_uuid, collections.OrderedDict())
+
+  def set_georef(self, georef):
+    self._chunk(b'RGEO', bytes(georef, 'ascii'))
+    self.georefs[self.current_run] = georef
+
+  def start_event(self, event_id):
+    self._flush_group()
+    self.current_span = [self.pos, self.pos]
+    self._chunk(b'EVNT', struct.pack('<I', event_id))
+    if self.index:
+      self.current_event = self.runs[self.current_run].setdefault(event_id, collections.OrderedDict())
+      self.spans[(self.current_run, event_id)] = self.current_span
+
+  def add_image(self, source, image):
+    fmtcode = image.fmtcode
+    data = None
+    if self.sparse and fmtcode == Fmtcode.Af32Tf32:
+      records = image.sparse()
+      if len(records) < self.sparse * image.width * image.height:
+        fmtcode = Fmtcode.SparseAf32Tf32
+        data = memoryview(records.view(numpy.uint8))
+    if data is None:
+      data = image.buffer()
+    ifmt = struct.pack('<HHBxxx', image.width, image.height, fmtcode)
+    if self.group:
+      self._pending_chunk(b'ISRC', bytes(source, 'ascii'))
+      self._pending_chunk(b'IFMT', ifmt)
+      if self.index:
+        self.pending_images.append((self.current_event, source,
+                                    (self.pending_len + 8, len(data), image.width, image.height, fmtcode)))
+      self._pending_chunk(b'IDAT', data)
+      return
+    self._chunk(b'ISRC', bytes(source, 'ascii'))
+    self._chunk(b'IFMT', ifmt)
+    if self.compress:
+      block = _compress(self.compress, data)
+      if self.index:
+        self.current_event[source] = (0, len(data), image.width, image.height, fmtcode, self.pos + 8, len(block))
+      self._chunk(b'ZDAT', block)
+      return
+    if self.index:
+      self.current_event[source] = (self.pos + 8, len(data), image.width, image.height, fmtcode, 0, 0)
+    self._chunk(b'IDAT', data)
+
+  def copy_event(self, reader, event_id, run=None):
+    if run is None:
+      run = next(r for r, rundata in reader.runs.items() if event_id in rundata)
+    self._flush_group()
+    start, end = reader.spans[(run, event_id)]
+    shift = self.pos - start
+    with memoryview(reader.map)[start:end] as data:
+      self.file.write(data)
+      self.crc = crc32(data, self.crc)
+    self.pos += end - start
+    self.current_span = None
+    if self.index:
+      self.runs[self.current_run][event_id] = collections.OrderedDict(
+        (src, _shift_entry(entry, shift)) for src, entry in reader.runs[run][event_id].items())
+      self.spans[(self.current_run, event_id)] = [start + shift, end + shift]
+
+  def checkpoint(self, trailer=False):
+    # with trailer the file is complete as it is, the trailer is overwritten by the next chunk
+    self._flush_group()
+    if trailer:
+      self._trailer()
+      self.file.seek(self.pos)
+    self.file.flush()
+    os.fsync(self.file.fileno())
+    return self.pos, self.crc
+
+  def close(self):
+    if self.file.closed:
+      return
+    self._flush_group()
+    self._trailer()
+    self.file.close()
+    if self.index:
+      write_index(self.fname, self)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+class DRDFReader:
+
+  def __init__(self, fname, verify=True, index=True, threads=None, cache=256):
+    self.file = open(fname, mode='rb')
+    self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+    # compressed blocks are decompressed in a thread pool, the last cache ones are kept
+    self.threads = threads
+    self.cache = cache
+    self.pool = None
+    self.blocks = collections.OrderedDict()
+    self.lock = threading.Lock()
+    found = read_index(fname) if index else None
+    if found is not None:
+      if verify:
+        # the index matches the size and the crc stored in the file, the data still has to be checked
+        self._verify(len(self.map) - 4)
+      self.runs, self.georefs, self.spans = found
+      return
+    self.runs = collections.OrderedDict()
+    self.georefs = {}
+    self.spans = {}
+    self._scan(verify)
+    if index:
+      try:
+        write_index(fname, self)
+      except OSError:
+        pass
+
+  def _verify(self, pos):
+    # crc of the file up to pos, against the one stored at pos in the ERAW chunk
+    crc_in_file, = struct.unpack_from('<I', self.map, pos)
+    with memoryview(self.map)[:pos] as data:
+      crc = crc32(data, 0xFFFFFFFF)
+    if crc_in_file != crc:
+      raise IOError('Checksum mismatch: calculated {0:08X}, expected {1:08X}'.format(crc, crc_in_file))
+
+  def _scan(self, verify):
+    buf = self.map
+    if buf[:8] != b'\x00\x00\x00\x00HRAW':
+      raise IOError('File header does not match')
+    pos = 8
+    tag = b'HRAW'
+    current_span = None
+    while tag != b'ERAW':
+      if pos + 8 > len(buf):
+        raise IOError('File is incomplete (ERAW tag missing)')
+      length, tag = struct.unpack_from('<I4s', buf, pos)
+      if tag in _expected_chunk_lengths and _expected_chunk_lengths[tag] != length:
+        raise IOError('Chunk size does not match expected value')
+      pos += 8
+      if pos + length > len(buf):
+        raise IOError('Chunk exceeds file size')
+      if tag == b'ERAW':
+        if verify:
+          self._verify(pos)
+      elif tag == b'RSTA':
+        run_uuid = uuid.UUID(bytes=buf[pos:pos + 16])
+        current_run = self.runs.setdefault(run_uuid, collections.OrderedDict())
+        current_span = None
+      elif tag == b'RGEO':
+        self.georefs[run_uuid] = buf[pos:pos + length].decode('ascii')
+      elif tag == b'EVNT':
+        evnum, = struct.unpack_from('<I', buf, pos)
+        current_event = current_run.setdefault(evnum, collections.OrderedDict())
+        current_span = self.spans[(run_uuid, evnum)] = [pos - 8, pos]
+      elif tag == b'IFMT':
+        current_fmt = struct.unpack_from('<HHBxxx', buf, pos)
+      elif tag == b'ISRC':
+        current_source = buf[pos:pos + length].decode('ascii')
+      elif tag == b'IDAT':
+        current_event[current_source] = (pos, length) + current_fmt + (0, 0)
+      elif tag == b'ZDAT':
+        codec, rawlen = _zhead.unpack_from(buf, pos)
+        current_event[current_source] = (0, rawlen) + current_fmt + (pos, length)
+      elif tag == b'ZEVT':
+        with memoryview(buf)[pos:pos + length] as compressed:
+          block = _decompress(compressed)
+        for itag, ipos, ilength in _inner_chunks(block):
+          if itag == b'IFMT':
+            current_fmt = struct.unpack_from('<HHBxxx', block, ipos)
+          elif itag == b'ISRC':
+            current_source = block[ipos:ipos + ilength].decode('ascii')
+          elif itag == b'IDAT':
+            current_event[current_source] = (ipos, ilength) + current_fmt + (pos, length)
+      pos += length
+      if current_span is not None and tag != b'ERAW':
+        current_span[1] = pos
+
+  def events(self, run=None):
+    if run is None:
+      return [evnum for rundata in self.runs.values() for evnum in rundata]
+    return list(self.runs[run])
+
+  def sources(self, event_id, run=None):
+    return list(self._find(event_id, run))
+
+  def image(self, event_id, source, run=None):
+    offset, length, x, y, fmt, block_offset, block_length = self._find(event_id, run)[source]
+    buf = self.map
+    if block_length:
+      buf = self._fetch([(block_offset, block_length)])[0].result()
+    if offset + length > len(buf):
+      raise IOError('Image exceeds its compressed block' if block_length else 'Image exceeds file size')
+    if fmt == Fmtcode.SparseAf32Tf32:
+      return Image(x, y, fmt, rawbytes=buf[offset:offset + length])
+    shape, dtype = _decode_fmt(x, y, fmt)
+    pixels = numpy.frombuffer(buf, dtype=dtype, count=length // numpy.dtype(dtype).itemsize, offset=offset)
+    return Image(numpy.reshape(pixels, shape, order='C'))
+
+  def event(self, event_id, sources=None, run=None):
+    eventdata = self._find(event_id, run)
+    if sources is None:
+      sources = eventdata.keys()
+    self._fetch(self._blocks(eventdata, sources))
+    return collections.OrderedDict((src, self.image(event_id, src, run)) for src in sources if src in eventdata)
+
+  def items(self, sources=None):
+    keys = [(run_uuid, event_id) for run_uuid, rundata in self.runs.items() for event_id in rundata]
+    for i, (run_uuid, event_id) in enumerate(keys):
+      for run_next, event_next in keys[i:i + 2]:            #this event and, in the background, the next one
+        eventdata = self.runs[run_next][event_next]
+        self._fetch(self._blocks(eventdata, eventdata.keys() if sources is None else sources))
+      yield run_uuid, event_id, self.event(event_id, sources, run_uuid)
+
+  def _blocks(self, eventdata, sources):
+    return list(collections.OrderedDict.fromkeys(eventdata[src][5:] for src in sources if src in eventdata and eventdata[src][6]))
+
+  def _decompress_block(self, offset, length):
+    with memoryview(self.map)[offset:offset + length] as compressed:
+      return _decompress(compressed)
+
+  def _fetch(self, blocks):
+    futures = []
+    if not blocks:
+      return futures
+    with self.lock:
+      if self.pool is None:
+        self.pool = ThreadPoolExecutor(self.threads)
+      for offset, length in blocks:
+        future = self.blocks.get(offset)
+        if future is None:
+          future = self.blocks[offset] = self.pool.submit(self._decompress_block, offset, length)
+        else:
+          self.blocks.move_to_end(offset)
+        futures.append(future)
+      while len(self.blocks) > max(self.cache, len(blocks)):
+        self.blocks.popitem(last=False)
+    return futures
+
+  def _find(self, event_id, run):
+    if run is not None:
+      return self.runs[run][event_id]
+    for rundata in self.runs.values():
+      if event_id in rundata:
+        return rundata[event_id]
+    raise KeyError('Event {0} not found'.format(event_id))
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.shutdown()
+      self.pool = None
+    self.blocks.clear()
+    try:
+      self.map.close()
+    except BufferError:
+      pass
+    self.file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
@@ -0,0 +1,316 @@
+/*
+ * Copyright 2020-2022 N. Tosi, V. Pia <nicolo.tosi@bo.infn.it>
+ *
+ * This program is free software:
+ * you can redistribute it and/or modify it under the terms of the GNU
+ * Lesser General Public License as published by the Free Software Foundation,
+ * either version 3 of the License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+ * See the GNU Lesser General Public License for more details.
+ *
+ * You should have received a copy of the GNU Lesser General Public License
+ * along with this program. If not, see <https://www.gnu.org/licenses/>.
+ */
+
+/* Python wrapper of libdrdf, used by drdf.DRDF.read and drdf.DRDF.write when it is built.
+   read() returns the runs, events and images of a file in file order, the pixels of each image
+   stay in the buffer allocated by libdrdf and are exposed through the buffer protocol, so that
+   numpy.frombuffer does not copy them. write() takes the runs of a DRDF object.*/
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <cerrno>
+#include <cstdio>
+#include <cstring>
+#include <utility>
+
+#include <sys/stat.h>
+
+#include "drdf.h"
+
+namespace
+ {
+
+  /* A Python error is already set.*/
+  struct python_error
+   {};
+
+  /* Owned reference, released when it goes out of scope.*/
+  class ref_t
+   {
+    public:
+    explicit ref_t(PyObject* obj = nullptr) : m_obj(obj)
+     {
+      if (!m_obj)
+        throw python_error();
+     }
+    ref_t(ref_t&& rhs) : m_obj(rhs.m_obj)
+     { rhs.m_obj = nullptr; }
+    ref_t(const ref_t&) = delete;
+    ~ref_t()
+     { Py_XDECREF(m_obj); }
+    PyObject* get() const
+     { return m_obj; }
+    PyObject* release()
+     { PyObject* obj = m_obj; m_obj = nullptr; return obj; }
+    private:
+    PyObject* m_obj;
+   };
+
+  /* Pixels of an image read by libdrdf.*/
+  struct pixels_object
+   {
+    PyObject_HEAD
+    drdf::image_base_t* image;
+   };
+
+  void pixels_dealloc(pixels_object* self)
+   {
+    delete self->image;
+    Py_TYPE(self)->tp_free(reinterpret_cast<PyObject*>(self));
+   }
+
+  int pixels_getbuffer(pixels_object* self, Py_buffer* view, int flags)
+   {
+    return PyBuffer_FillInfo(view, reinterpret_cast<PyObject*>(self), const_cast<void*>(self->image->pixels()),
+                             self->image->size(), 0, flags);           // owned by the object, so numpy may write to it
+   }
+
+  PyBufferProcs pixels_as_buffer = {reinterpret_cast<getbufferproc>(pixels_getbuffer), nullptr};
+
+  PyTypeObject pixels_type = {PyVarObject_HEAD_INIT(nullptr, 0)};
+
+  /* Builds [[uuid bytes, georef or None, [(event id, [(source, width, height, fmt, pixels), ...]), ...]], ...]*/
+  class list_reader_t : public drdf::reader_t
+   {
+    public:
+    list_reader_t() : runs(PyList_New(0)), images(nullptr), events(nullptr), run(nullptr)
+     {}
+    void start_run(const drdf::run_uuid_t& uuid) override
+     {
+      ref_t run_events(PyList_New(0));
+      ref_t item(Py_BuildValue("[y#OO]", reinterpret_cast<const char*>(uuid.uuid), Py_ssize_t(16), Py_None, run_events.get()));
+      append(runs.get(), item);
+      run = item.get();
+      events = run_events.get();
+      images = nullptr;
+     }
+    void set_georef(const drdf::uri_t& georef) override
+     {
+      if (!run)
+        throw std::invalid_argument("Georef outside of runs");
+      ref_t value(PyUnicode_DecodeASCII(georef.data(), georef.size(), nullptr));
+      if (PyList_SetItem(run, 1, value.release()))
+        throw python_error();
+     }
+    void start_event(drdf::eventid_t event) override
+     {
+      if (!events)
+        throw std::invalid_argument("Event outside of runs");
+      ref_t event_images(PyList_New(0));
+      ref_t item(Py_BuildValue("(kO)", static_cast<unsigned long>(event), event_images.get()));
+      append(events, item);
+      images = event_images.get();
+     }
+    void add_image(const drdf::sourceid_t& source, drdf::image_base_t&& img) override
+     {
+      if (!images)
+        throw std::invalid_argument("Image outside of events");
+      ref_t pixels(PyType_GenericAlloc(&pixels_type, 0));
+      reinterpret_cast<pixels_object*>(pixels.get())->image = new drdf::image_base_t(std::move(img));
+      const drdf::ifmt_t& fmt = reinterpret_cast<pixels_object*>(pixels.get())->image->format();
+      ref_t item(Py_BuildValue("(s#iiiO)", source.data(), Py_ssize_t(source.size()),
+                               int(fmt.size_x), int(fmt.size_y), int(fmt.pixelfmt), pixels.get()));
+      append(images, item);
+     }
+    ref_t runs;
+    private:
+    static void append(PyObject* list, const ref_t& item)
+     {
+      if (PyList_Append(list, item.get()))
+        throw python_error();
+     }
+    PyObject* images;
+    PyObject* events;
+    PyObject* run;
+   };
+
+  PyObject* set_error(const std::exception& e)
+   {
+    PyErr_SetString(PyExc_IOError, e.what());
+    return nullptr;
+   }
+
+  /* Sets the OSError that open() raises for fname (FileNotFoundError, PermissionError, IsADirectoryError...),
+     libdrdf only reports that it cannot open it.*/
+  bool open_error(const char* fname, const char* mode)
+   {
+    FILE* file = std::fopen(fname, mode);
+    if (file)
+     {
+      struct stat st;
+      bool directory = !fstat(fileno(file), &st) && S_ISDIR(st.st_mode);
+      std::fclose(file);
+      if (!directory)
+        return false;
+      errno = EISDIR;
+     }
+    PyErr_SetFromErrnoWithFilename(PyExc_OSError, fname);
+    return true;
+   }
+
+  PyObject* read(PyObject*, PyObject* args)
+   {
+    const char* fname;
+    if (!PyArg_ParseTuple(args, "s", &fname) || open_error(fname, "rb"))
+      return nullptr;
+    try
+     {
+      list_reader_t reader;
+      drdf::drdf::read(fname, reader);
+      return reader.runs.release();
+     }
+    catch (const python_error&)
+     {
+      return nullptr;
+     }
+    catch (const std::exception& e)
+     {
+      return set_error(e);
+     }
+   }
+
+  std::string ascii(PyObject* obj)
+   {
+    Py_ssize_t size;
+    const char* data = PyUnicode_AsUTF8AndSize(obj, &size);
+    if (!data)
+      throw python_error();
+    return std::string(data, size);
+   }
+
+  unsigned long attr_ulong(PyObject* obj, const char* name)
+   {
+    ref_t value(PyObject_GetAttrString(obj, name));
+    unsigned long ret = PyLong_AsUnsignedLong(value.get());
+    if (PyErr_Occurred())
+      throw python_error();
+    return ret;
+   }
+
+  /* (key, value) pairs of a dictionary, in its order.*/
+  ref_t items(PyObject* dict)
+   {
+    ref_t list(PyMapping_Items(dict));
+    return ref_t(PySequence_Fast(list.get(), "items() is not a sequence"));
+   }
+
+  void write_image(drdf::writer_t& file, PyObject* source, PyObject* image)
+   {
+    drdf::ifmt_t fmt{};
+    fmt.size_x = attr_ulong(image, "width");
+    fmt.size_y = attr_ulong(image, "height");
+    fmt.pixelfmt = drdf::ifmttype_t(attr_ulong(image, "fmtcode"));
+    if (fmt.pixelfmt > drdf::Af32Tf32)
+      throw std::invalid_argument("Invalid image format: " + std::to_string(fmt.pixelfmt));
+    ref_t data(PyObject_CallMethod(image, "buffer", nullptr));           // contiguous bytes of the pixels, not copied
+    Py_buffer view;
+    if (PyObject_GetBuffer(data.get(), &view, PyBUF_SIMPLE))
+      throw python_error();
+    if (view.len != fmt.size())
+     {
+      PyBuffer_Release(&view);
+      throw std::invalid_argument("Image " + ascii(source) + " has " + std::to_string(view.len)
+                                  + " bytes, expected " + std::to_string(fmt.size()));
+     }
+    try
+     {
+      file.add_image(ascii(source), fmt, view.buf);
+     }
+    catch (...)
+     {
+      PyBuffer_Release(&view);
+      throw;
+     }
+    PyBuffer_Release(&view);
+   }
+
+  PyObject* write(PyObject*, PyObject* args)
+   {
+    const char* fname;
+    PyObject* runs;
+    float sparse_density;
+    if (!PyArg_ParseTuple(args, "sOf", &fname, &runs, &sparse_density) || open_error(fname, "wb"))
+      return nullptr;
+    try
+     {
+      drdf::writer_t file(fname, sparse_density);
+      ref_t run_items(items(runs));
+      for (Py_ssize_t i = 0; i < PySequence_Fast_GET_SIZE(run_items.get()); ++i)
+       {
+        PyObject* run = PySequence_Fast_GET_ITEM(run_items.get(), i);
+        PyObject* rundata = PyTuple_GET_ITEM(run, 1);
+        ref_t uuid_bytes(PyObject_GetAttrString(PyTuple_GET_ITEM(run, 0), "bytes"));
+        drdf::run_uuid_t uuid;
+        if (!PyBytes_Check(uuid_bytes.get()) || PyBytes_GET_SIZE(uuid_bytes.get()) != 16)
+          throw std::invalid_argument("Run is not a UUID");
+        std::memcpy(uuid.uuid, PyBytes_AS_STRING(uuid_bytes.get()), 16);
+        file.start_run(uuid);
+        ref_t georef(PyObject_GetAttrString(rundata, "georef"));
+        file.set_georef(ascii(georef.get()));
+        ref_t event_items(items(rundata));
+        for (Py_ssize_t j = 0; j < PySequence_Fast_GET_SIZE(event_items.get()); ++j)
+         {
+          PyObject* event = PySequence_Fast_GET_ITEM(event_items.get(), j);
+          unsigned long event_id = PyLong_AsUnsignedLong(PyTuple_GET_ITEM(event, 0));
+          if (PyErr_Occurred())
+            throw python_error();
+          file.start_event(drdf::eventid_t(event_id));
+          ref_t image_items(items(PyTuple_GET_ITEM(event, 1)));
+          for (Py_ssize_t k = 0; k < PySequence_Fast_GET_SIZE(image_items.get()); ++k)
+           {
+            PyObject* image = PySequence_Fast_GET_ITEM(image_items.get(), k);
+            write_image(file, PyTuple_GET_ITEM(image, 0), PyTuple_GET_ITEM(image, 1));
+           }
+         }
+       }
+      file.close();
+     }
+    catch (const python_error&)
+     {
+      return nullptr;
+     }
+    catch (const std::exception& e)
+     {
+      return set_error(e);
+     }
+    Py_RETURN_NONE;
+   }
+
+  PyMethodDef methods[] =
+   {
+    {"read", read, METH_VARARGS, "read(fname): runs of the file as [[uuid bytes, georef, [(event, [(source, width, height, fmt, pixels), ...]), ...]], ...]"},
+    {"write", write, METH_VARARGS, "write(fname, runs, sparse_density): writes the runs of a DRDF object"},
+    {nullptr, nullptr, 0, nullptr}
+   };
+
+  PyModuleDef module = {PyModuleDef_HEAD_INIT, "_libdrdf", "Python wrapper of libdrdf", -1, methods};
+
+ }
+
+PyMODINIT_FUNC PyInit__libdrdf()
+ {
+  pixels_type.tp_name = "drdf._libdrdf.Pixels";
+  pixels_type.tp_doc = "Pixels of an image read by libdrdf, exposed through the writable buffer protocol";
+  pixels_type.tp_basicsize = sizeof(pixels_object);
+  pixels_type.tp_flags = Py_TPFLAGS_DEFAULT;
+  pixels_type.tp_dealloc = reinterpret_cast<destructor>(pixels_dealloc);
+  pixels_type.tp_as_buffer = &pixels_as_buffer;
+  if (PyType_Ready(&pixels_type) < 0)
+    return nullptr;
+  return PyModule_Create(&module);
+ }
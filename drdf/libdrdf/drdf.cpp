@@ -16,11 +16,15 @@
  */
 
 #include <algorithm>
+#include <cmath>
 #include <cstring>
 #include <fstream>
 #include <memory>
 #include <stdexcept>
 
+#include <lzma.h>
+#include <zlib.h>
+
 #include "drdf.h"
 
 namespace drdf
@@ -37,7 +41,9 @@ namespace drdf
     IDAT = 6,
     ISRC = 7,
     IFMT = 8,
-    _LAST = 9
+    ZDAT = 9,
+    ZEVT = 10,
+    _LAST = 11
    };
 
   static const char chunknames[_LAST][5] = {
@@ -50,6 +56,8 @@ namespace drdf
     "IDAT",
     "ISRC",
     "IFMT",
+    "ZDAT",
+    "ZEVT",
    };
 
   static const uint32_t pixsizes[] =
@@ -58,7 +66,8 @@ namespace drdf
     2,
     2,
     4,
-    8
+    8,
+    12
    };
 
   run_uuid_t get_uuid()
@@ -76,6 +85,7 @@ namespace drdf
    }
 
   static_assert(sizeof(ifmt_t)==8);
+  static_assert(sizeof(pixtype_SparseAf32Tf32_t)==12);
 
   uint32_t ifmt_t::size() const
    {
@@ -121,6 +131,117 @@ namespace drdf
     return *this;
    }
 
+  /* CRC-32 of [begin, end) continuing from partial, the same as zlib (and Python binascii.crc32), which computes it
+     several bytes at a time. Long buffers are split since zlib takes the length as an unsigned int.*/
+  static checksum_t crc32(checksum_t partial, const char* begin, const char* end)
+   {
+    const size_t step = 1u << 30;
+    if (begin == end)
+      return partial;                                         // zlib returns 0 for a null buffer
+    for ( ; end - begin > ptrdiff_t(step); begin += step)
+      partial = ::crc32(partial, reinterpret_cast<const Bytef*>(begin), step);
+    return ::crc32(partial, reinterpret_cast<const Bytef*>(begin), end - begin);
+   }
+
+  /* Sparse images are expanded to Af32Tf32 as soon as they are read, so users only see dense images.*/
+  static image_base_t decode_image(const ifmt_t& fmt, const char* data, uint32_t len)
+   {
+    if (fmt.pixelfmt != SparseAf32Tf32)
+     {
+      if (len != fmt.size())
+        throw std::out_of_range("IDAT chunk has invalid length: " + std::to_string(len)
+                                + " (expected " + std::to_string(fmt.size()) + ")");
+      return image_base_t(fmt, data);
+     }
+    if (len % sizeof(pixtype_SparseAf32Tf32_t) || len > fmt.size())
+      throw std::out_of_range("IDAT chunk has invalid length for a sparse image: " + std::to_string(len));
+    image_t<pixtype_Af32Tf32_t> image(fmt.size_x, fmt.size_y);
+    const uint32_t npixels = uint32_t(fmt.size_x) * fmt.size_y;
+    std::fill(image.pixels(), image.pixels() + npixels, pixtype_Af32Tf32_t{0.f, NAN});
+    for (uint32_t i = 0; i < len; i += sizeof(pixtype_SparseAf32Tf32_t))
+     {
+      pixtype_SparseAf32Tf32_t record;
+      std::memcpy(&record, data + i, sizeof(record));
+      if (record.index >= npixels)
+        throw std::out_of_range("Sparse pixel index out of range: " + std::to_string(record.index));
+      image.pixels()[record.index] = pixtype_Af32Tf32_t{record.amplitude, record.time};
+     }
+    return std::move(image);
+   }
+
+  /* Non-empty pixels of an Af32Tf32 image, if they are less than sparse_density of the total.*/
+  static bool encode_sparse(const ifmt_t& fmt, const void* pxls, float sparse_density,
+                            std::vector<pixtype_SparseAf32Tf32_t>& records)
+   {
+    records.clear();
+    if (fmt.pixelfmt != Af32Tf32)
+      return false;
+    const uint32_t npixels = uint32_t(fmt.size_x) * fmt.size_y;
+    const auto* pixels = static_cast<const pixtype_Af32Tf32_t*>(pxls);
+    for (uint32_t i = 0; i < npixels; ++i)
+     {
+      if (pixels[i].amplitude != 0 || !std::isnan(pixels[i].time))
+        records.push_back(pixtype_SparseAf32Tf32_t{i, pixels[i].amplitude, pixels[i].time});
+      if (records.size() >= sparse_density * npixels)
+        return false;
+     }
+    return true;
+   }
+
+  /* ZDAT and ZEVT payloads: u8 codec, 3 reserved bytes, u32 uncompressed length, compressed data.*/
+  static std::vector<char> decompress(const char* data, uint32_t len)
+   {
+    if (len < 8)
+      throw std::out_of_range("Compressed chunk is too short: " + std::to_string(len));
+    uint8_t codec = data[0];
+    uint32_t rawlen;
+    std::memcpy(&rawlen, data + 4, 4);
+    std::vector<char> out(rawlen);
+    if (codec == Zlib)
+     {
+      uLongf outlen = rawlen;
+      if (::uncompress(reinterpret_cast<Bytef*>(out.data()), &outlen,
+                       reinterpret_cast<const Bytef*>(data + 8), len - 8) != Z_OK || outlen != rawlen)
+        throw std::runtime_error("Corrupted zlib chunk");
+     }
+    else if (codec == Lzma)
+     {
+      uint64_t memlimit = UINT64_MAX;
+      size_t inpos = 0, outpos = 0;
+      if (::lzma_stream_buffer_decode(&memlimit, 0, nullptr, reinterpret_cast<const uint8_t*>(data + 8), &inpos, len - 8,
+                                      reinterpret_cast<uint8_t*>(out.data()), &outpos, rawlen) != LZMA_OK || outpos != rawlen)
+        throw std::runtime_error("Corrupted lzma chunk");
+     }
+    else
+      throw std::invalid_argument("Unknown compression codec: " + std::to_string(codec));
+    return out;
+   }
+
+  /* Calls f(source, format, offset, length) for every IDAT in a decompressed ZEVT block.*/
+  template <typename F>
+  static void for_each_image(const std::vector<char>& block, F f)
+   {
+    sourceid_t source;
+    ifmt_t format{};
+    size_t pos = 0;
+    while (pos + 8 <= block.size())
+     {
+      uint32_t len;
+      std::memcpy(&len, block.data() + pos, 4);
+      const char* tag = block.data() + pos + 4;
+      pos += 8;
+      if (len > block.size() - pos)
+        throw std::out_of_range("Chunk of invalid length in compressed block: " + std::to_string(len));
+      if (!std::memcmp(tag, chunknames[ISRC], 4))
+        source.assign(block.data() + pos, len);
+      else if (!std::memcmp(tag, chunknames[IFMT], 4) && len == sizeof(ifmt_t))
+        std::memcpy(&format, block.data() + pos, sizeof(ifmt_t));
+      else if (!std::memcmp(tag, chunknames[IDAT], 4))
+        f(source, format, pos, len);
+      pos += len;
+     }
+   }
+
   drdf::drdf() :
    m_runs(), m_run(m_runs.end())
    {}
@@ -144,6 +265,37 @@ namespace drdf
    }
 
   drdf drdf::read(uri_t fname)
+   {
+    /* Keeps the first image of each source of an event, as std::map::emplace does.*/
+    struct : public reader_t
+     {
+      drdf ret;
+      run_uuid_t run;
+      eventid_t event;
+      void start_run(const run_uuid_t& uuid) override
+       {
+        run = uuid;
+        ret.m_runs.emplace(run, run_map_t());
+       }
+      void set_georef(const uri_t& georef) override
+       {
+        ret.m_runs[run].georef = georef;
+       }
+      void start_event(eventid_t evnt) override
+       {
+        event = evnt;
+        ret.m_runs[run].emplace(event, event_map_t());
+       }
+      void add_image(const sourceid_t& source, image_base_t&& img) override
+       {
+        ret.m_runs[run][event].emplace(source, std::move(img));
+       }
+     } reader;
+    read(fname, reader);
+    return std::move(reader.ret);
+   }
+
+  void drdf::read(uri_t fname, reader_t& reader)
    {
     std::ifstream file(fname.c_str(), std::ios::binary | std::ios::ate);
     if (!file)
@@ -159,24 +311,20 @@ namespace drdf
     checksum_t checksum = crc32(0xFFFFFFFFu, read, end - 4);
     checksum_t crc_in_file;
     read += 8;
-    run_uuid_t current_run;
-    eventid_t current_event;
     sourceid_t current_source;
     ifmt_t current_ifmt;
     chunktype_t current_chunk = HRAW;
     bool got_end = false;
-    drdf ret;
     while (current_chunk != ERAW)
      {
+      if (end - read < 8)
+        break;
       uint32_t chunklen = *reinterpret_cast<const uint32_t*>(read);
       read += 4;
       int ct = 0;
-      while (std::memcmp(chunknames[ct], read, 4) && ct < _LAST)
+      while (ct < _LAST && std::memcmp(chunknames[ct], read, 4))
         ++ct;
       current_chunk = chunktype_t(ct);
-      if (current_chunk == _LAST)
-        throw std::invalid_argument(fname + " contains chunk of invalid type: "
-                                    + std::string(read,4));
       read += 4;
       if (end - read < chunklen)
         throw std::out_of_range(fname + " contains chunk of invalid length: "
@@ -197,21 +345,19 @@ namespace drdf
         if (chunklen != 16)
           throw std::out_of_range(fname + " contains RSTA chunk of invalid length: "
                                   + std::to_string(chunklen) + " (expected 16)");
-        current_run = *reinterpret_cast<const run_uuid_t*>(read);
-        ret.m_runs.emplace(current_run, run_map_t());
+        reader.start_run(*reinterpret_cast<const run_uuid_t*>(read));
         break;
         case RCCD:
         // do nothing  std::string(read, read + chunklen);
         break;
         case RGEO:
-        ret.m_runs[current_run].georef = std::string(read, read + chunklen);
+        reader.set_georef(std::string(read, read + chunklen));
         break;
         case EVNT:
         if (chunklen != 4)
           throw std::out_of_range(fname + " contains EVNT chunk of invalid length: "
                                   + std::to_string(chunklen) + " (expected 4)");
-        current_event = *reinterpret_cast<const uint32_t*>(read);
-        ret.m_runs[current_run].emplace(current_event, event_map_t());
+        reader.start_event(*reinterpret_cast<const uint32_t*>(read));
         break;
         case IFMT:
         if (chunklen != sizeof(ifmt_t))
@@ -223,89 +369,383 @@ namespace drdf
         current_source = std::string(read, read + chunklen);
         break;
         case IDAT:
-        if (chunklen != current_ifmt.size())
-          throw std::out_of_range("IDAT chunk has invalid length: " + std::to_string(chunklen)
-                                  + " (expected " + std::to_string(current_ifmt.size()) + ")");
-        ret.m_runs[current_run][current_event].emplace(current_source, image_base_t(current_ifmt, read));
+        reader.add_image(current_source, decode_image(current_ifmt, read, chunklen));
+        break;
+        case ZDAT:
+         {
+          auto data = decompress(read, chunklen);
+          reader.add_image(current_source, decode_image(current_ifmt, data.data(), data.size()));
+         }
+        break;
+        case ZEVT:
+         {
+          auto block = decompress(read, chunklen);
+          for_each_image(block, [&](const sourceid_t& source, const ifmt_t& format, size_t offset, uint32_t length)
+           {
+            reader.add_image(source, decode_image(format, block.data() + offset, length));
+           });
+         }
         break;
         case _LAST:
-        //cannot reach, handled before switch
+        // unknown chunk from a newer writer, skipped as the Python reader does
         break;
        };
       read += chunklen;
      }
     if (!got_end)
       throw std::invalid_argument(fname + " is incomplete (ERAW tag missing)");
-    return ret;
    }
 
-  checksum_t drdf::write_chunk(std::ofstream& file, const char* tag, uint32_t len, const void* data, checksum_t crc)
+  writer_t::writer_t(uri_t fname, float sparse_density):
+   m_fname(fname), m_file(fname.c_str(), std::ios::out | std::ios::binary), m_crc(0xFFFFFFFFu),
+   m_sparse_density(sparse_density), m_records()
+   {
+    if (!m_file)
+      throw std::runtime_error("Cannot write " + fname);
+    write_chunk(chunknames[HRAW], 0, nullptr);
+   }
+
+  void writer_t::write_chunk(const char* tag, uint32_t len, const void* data)
    {
     char buffer[8];
     std::memcpy(buffer, &len, 4);
     std::memcpy(buffer + 4, tag, 4);
-    file.write(buffer, 8);
-    crc = crc32(crc, buffer, buffer + 8);
+    m_file.write(buffer, 8);
+    m_crc = crc32(m_crc, buffer, buffer + 8);
     const char* pdata = static_cast<const char*>(data);
-    file.write(pdata, len);
-    return crc32(crc, pdata, pdata + len);
+    m_file.write(pdata, len);
+    m_crc = crc32(m_crc, pdata, pdata + len);
+   }
+
+  void writer_t::start_run(const run_uuid_t& run)
+   {
+    write_chunk(chunknames[RSTA], sizeof(run_uuid_t), &run);
+   }
+
+  void writer_t::set_georef(const uri_t& georef)
+   {
+    write_chunk(chunknames[RGEO], georef.size(), georef.c_str());
+   }
+
+  void writer_t::start_event(eventid_t evnt)
+   {
+    write_chunk(chunknames[EVNT], 4, &evnt);
+   }
+
+  void writer_t::add_image(const sourceid_t& source, const ifmt_t& fmt, const void* pxls)
+   {
+    write_chunk(chunknames[ISRC], source.size(), source.c_str());
+    if (m_sparse_density > 0 && encode_sparse(fmt, pxls, m_sparse_density, m_records))
+     {
+      ifmt_t format = fmt;
+      format.pixelfmt = SparseAf32Tf32;
+      write_chunk(chunknames[IFMT], sizeof(ifmt_t), &format);
+      write_chunk(chunknames[IDAT], m_records.size() * sizeof(pixtype_SparseAf32Tf32_t), m_records.data());
+      return;
+     }
+    write_chunk(chunknames[IFMT], sizeof(ifmt_t), &fmt);
+    write_chunk(chunknames[IDAT], fmt.size(), pxls);
+   }
+
+  void writer_t::close()
+   {
+    const char end[9] = "\x04\0\0\0ERAW";
+    checksum_t crc = crc32(m_crc, end, end + 8);
+    write_chunk(chunknames[ERAW], 4, &crc);
+    m_file.close();
+    if (!m_file)
+      throw std::runtime_error("Error writing " + m_fname);
    }
 
-  void drdf::write(uri_t fname)
+  void drdf::write(uri_t fname, bool index, float sparse_density)
    {
-    std::ofstream file(fname.c_str(), std::ios::out | std::ios::binary);
-    checksum_t crc = 0xFFFFFFFFu;
-    crc = write_chunk(file, chunknames[HRAW], 0, nullptr, crc);
-    for (const auto& run: m_runs)
      {
-      crc = write_chunk(file, chunknames[RSTA], sizeof(run_uuid_t), &run.first, crc);
-      auto georef = run.second.georef;
-      crc = write_chunk(file, chunknames[RGEO], georef.size(), georef.c_str(), crc);
-      for (const auto& event: run.second)
+      writer_t file(fname, sparse_density);
+      for (const auto& run: m_runs)
        {
-       crc = write_chunk(file, chunknames[EVNT], 4, &event.first, crc);
-        for (const auto& image: event.second)
+        file.start_run(run.first);
+        file.set_georef(run.second.georef);
+        for (const auto& event: run.second)
          {
-          crc = write_chunk(file, chunknames[ISRC], image.first.size(), image.first.c_str(), crc);
-          crc = write_chunk(file, chunknames[IFMT], sizeof(ifmt_t), &image.second.format(), crc);
-          crc = write_chunk(file, chunknames[IDAT], image.second.size(), image.second.pixels(), crc);
+          file.start_event(event.first);
+          for (const auto& image: event.second)
+            file.add_image(image.first, image.second.format(), image.second.pixels());
          }
        }
+      file.close();
      }
-    const char end[9] = "\x04\0\0\0ERAW";
-    crc = crc32(crc, end, end + 8);
-    write_chunk(file, chunknames[ERAW], 4, &crc, crc);
+    if (index)
+      write_index(fname);
+   }
+
+  /* Sidecar index, stored in fname + ".idx" (all fields little endian):
+     "DRIX", u32 version, u64 size and u32 checksum of the indexed file, u32 number of runs,
+     for each run: 16 byte UUID, u16 length + georef,
+     u32 number of events,
+     for each event: u32 run (position in the list above), u32 event id,
+     u64 offset of the EVNT chunk, u64 offset past its last chunk, u32 number of images,
+     for each image: u16 length + source, 8 byte ifmt_t, u64 offset and u32 length of the IDAT payload,
+     u64 offset and u32 length of the ZDAT/ZEVT payload holding it (0 if the image is not compressed,
+     otherwise the IDAT offset is counted in the decompressed block).*/
+
+  static bool file_signature(const uri_t& fname, uint64_t& size, checksum_t& crc)
+   {
+    std::ifstream file(fname.c_str(), std::ios::binary | std::ios::ate);
+    if (!file)
+      return false;
+    size = file.tellg();
+    if (size < 20)
+      return false;
+    char tail[12];
+    file.seekg(size - 12);
+    file.read(tail, 12);
+    if (!file || std::memcmp(tail + 4, chunknames[ERAW], 4))
+      return false;
+    std::memcpy(&crc, tail + 8, 4);
+    return true;
+   }
+
+  bool drdf::load_index(const uri_t& fname, index_t& index)
+   {
+    std::ifstream file((fname + ".idx").c_str(), std::ios::binary | std::ios::ate);
+    if (!file)
+      return false;
+    std::vector<char> buffer(file.tellg());
+    file.seekg(0, std::ios::beg);
+    file.read(buffer.data(), buffer.size());
+    const char* read = buffer.data();
+    const char* end = read + buffer.size();
+    auto get = [&](void* dst, size_t len)
+     {
+      if (end - read < std::ptrdiff_t(len))
+        return false;
+      std::memcpy(dst, read, len);
+      read += len;
+      return true;
+     };
+    auto get_string = [&](std::string& dst)
+     {
+      uint16_t len;
+      if (!get(&len, 2) || end - read < len)
+        return false;
+      dst.assign(read, len);
+      read += len;
+      return true;
+     };
+    char magic[4];
+    uint32_t version, nruns, nevents;
+    uint64_t size;
+    checksum_t crc;
+    if (!get(magic, 4) || std::memcmp(magic, "DRIX", 4) || !get(&version, 4) || version != 2
+        || !get(&index.size, 8) || !get(&index.crc, 4) || !get(&nruns, 4))
+      return false;
+    if (!file_signature(fname, size, crc) || size != index.size || crc != index.crc)
+      return false;
+    index.runs.resize(nruns);
+    for (auto& run : index.runs)
+      if (!get(run.first.uuid, 16) || !get_string(run.second))
+        return false;
+    if (!get(&nevents, 4))
+      return false;
+    index.events.resize(nevents);
+    for (auto& event : index.events)
+     {
+      uint32_t nimages;
+      if (!get(&event.run, 4) || event.run >= nruns || !get(&event.event, 4)
+          || !get(&event.begin, 8) || !get(&event.end, 8) || !get(&nimages, 4))
+        return false;
+      event.images.resize(nimages);
+      for (auto& image : event.images)
+        if (!get_string(image.source) || !get(&image.format, sizeof(ifmt_t))
+            || !get(&image.offset, 8) || !get(&image.length, 4)
+            || !get(&image.block_offset, 8) || !get(&image.block_length, 4))
+          return false;
+     }
+    return true;
    }
 
-  std::array<checksum_t, 256> drdf::generate_crc_table()
+  drdf::index_t drdf::scan_index(const uri_t& fname)
    {
-    std::array<checksum_t, 256> table;
-    checksum_t rem;
-    for (int i = 0; i < 256; i++)
+    index_t index;
+    if (!file_signature(fname, index.size, index.crc))
+      throw std::invalid_argument(fname + " is not a complete Detector Response file.");
+    std::ifstream file(fname.c_str(), std::ios::binary);
+    file.seekg(8);
+    uint64_t pos = 8;
+    sourceid_t current_source;
+    ifmt_t current_ifmt{};
+    bool in_event = false;
+    std::string body;
+    while (pos + 8 <= index.size)
      {
-      rem = i;  /* remainder from polynomial division */
-      for (int j = 0; j < 8; j++)
+      char head[8];
+      file.read(head, 8);
+      uint32_t chunklen;
+      std::memcpy(&chunklen, head, 4);
+      pos += 8;
+      if (!std::memcmp(head + 4, chunknames[ERAW], 4))
+        break;
+      if (pos + chunklen > index.size)
+        throw std::out_of_range(fname + " contains chunk of invalid length: "
+                                + std::to_string(chunklen) + " (exceeds file size)");
+      if (!std::memcmp(head + 4, chunknames[IDAT], 4))
+       {
+        if (in_event)
+          index.events.back().images.push_back(index_image_t{current_source, current_ifmt, pos, chunklen, 0, 0});
+        file.seekg(chunklen, std::ios::cur);
+       }
+      else
        {
-        if (rem & 1)
+        body.resize(chunklen);
+        file.read(&body[0], chunklen);
+        if (!std::memcmp(head + 4, chunknames[RSTA], 4) && chunklen == 16)
+         {
+          run_uuid_t run;
+          std::memcpy(run.uuid, body.data(), 16);
+          index.runs.emplace_back(run, uri_t());
+          in_event = false;
+         }
+        else if (!std::memcmp(head + 4, chunknames[RGEO], 4) && !index.runs.empty())
+          index.runs.back().second = body;
+        else if (!std::memcmp(head + 4, chunknames[EVNT], 4) && chunklen == 4 && !index.runs.empty())
+         {
+          eventid_t evnt;
+          std::memcpy(&evnt, body.data(), 4);
+          index.events.push_back(index_event_t{uint32_t(index.runs.size() - 1), evnt, pos - 8, pos, {}});
+          in_event = true;
+         }
+        else if (!std::memcmp(head + 4, chunknames[ISRC], 4))
+          current_source = body;
+        else if (!std::memcmp(head + 4, chunknames[IFMT], 4) && chunklen == sizeof(ifmt_t))
+          std::memcpy(&current_ifmt, body.data(), sizeof(ifmt_t));
+        else if (!std::memcmp(head + 4, chunknames[ZDAT], 4) && in_event && chunklen >= 8)
          {
-          rem >>= 1;
-          rem ^= 0xedb88320ul;
+          uint32_t rawlen;
+          std::memcpy(&rawlen, body.data() + 4, 4);
+          index.events.back().images.push_back(index_image_t{current_source, current_ifmt, 0, rawlen, pos, chunklen});
          }
-        else
-          rem >>= 1;
+        else if (!std::memcmp(head + 4, chunknames[ZEVT], 4) && in_event)
+         {
+          auto& images = index.events.back().images;
+          for_each_image(decompress(body.data(), chunklen), [&](const sourceid_t& source, const ifmt_t& format, size_t offset, uint32_t length)
+           {
+            images.push_back(index_image_t{source, format, offset, length, pos, chunklen});
+           });
+         }
+       }
+      pos += chunklen;
+      if (in_event)
+        index.events.back().end = pos;
+     }
+    return index;
+   }
+
+  void drdf::save_index(const uri_t& fname, const index_t& index)
+   {
+    std::ofstream file((fname + ".idx").c_str(), std::ios::out | std::ios::binary);
+    if (!file)
+      throw std::runtime_error("Cannot write index for " + fname);
+    auto put = [&](const void* src, size_t len)
+     {
+      file.write(static_cast<const char*>(src), len);
+     };
+    auto put_string = [&](const std::string& src)
+     {
+      uint16_t len = src.size();
+      put(&len, 2);
+      put(src.data(), len);
+     };
+    const uint32_t version = 2;
+    const uint32_t nruns = index.runs.size();
+    const uint32_t nevents = index.events.size();
+    put("DRIX", 4);
+    put(&version, 4);
+    put(&index.size, 8);
+    put(&index.crc, 4);
+    put(&nruns, 4);
+    for (const auto& run : index.runs)
+     {
+      put(run.first.uuid, 16);
+      put_string(run.second);
+     }
+    put(&nevents, 4);
+    for (const auto& event : index.events)
+     {
+      const uint32_t nimages = event.images.size();
+      put(&event.run, 4);
+      put(&event.event, 4);
+      put(&event.begin, 8);
+      put(&event.end, 8);
+      put(&nimages, 4);
+      for (const auto& image : event.images)
+       {
+        put_string(image.source);
+        put(&image.format, sizeof(ifmt_t));
+        put(&image.offset, 8);
+        put(&image.length, 4);
+        put(&image.block_offset, 8);
+        put(&image.block_length, 4);
        }
-      table[i] = rem;
      }
-    return table;
    }
 
-  checksum_t drdf::crc32(checksum_t partial, const char* begin, const char* end)
+  void drdf::write_index(uri_t fname)
+   {
+    save_index(fname, scan_index(fname));
+   }
+
+  drdf drdf::read(uri_t fname, const std::vector<eventid_t>& events)
    {
-    static std::array<checksum_t, 256> table = generate_crc_table();
-    checksum_t crc = ~partial;
-    for ( ; begin < end; ++begin)
-     crc = (crc >> 8) ^ table[(crc & 0xff) ^ uint8_t(*begin)];
-    return ~crc;
+    index_t index;
+    if (!load_index(fname, index))
+     {
+      index = scan_index(fname);
+      try
+       {
+        save_index(fname, index);
+       }
+      catch (const std::exception&)
+       {
+        // read-only location, keep the index in memory only
+       }
+     }
+    std::ifstream file(fname.c_str(), std::ios::binary);
+    drdf ret;
+    for (const auto& run : index.runs)
+      ret.m_runs[run.first].georef = run.second;
+    std::vector<char> buffer;
+    std::vector<char> block;
+    uint64_t block_offset = 0;  // last decompressed block, shared by all the images of a ZEVT
+    for (const auto& event : index.events)
+     {
+      if (std::find(events.begin(), events.end(), event.event) == events.end())
+        continue;
+      auto& images = ret.m_runs[index.runs[event.run].first][event.event];
+      for (const auto& image : event.images)
+       {
+        if (image.block_length)
+         {
+          if (block_offset != image.block_offset)
+           {
+            buffer.resize(image.block_length);
+            file.seekg(image.block_offset);
+            file.read(buffer.data(), image.block_length);
+            block = decompress(buffer.data(), image.block_length);
+            block_offset = image.block_offset;
+           }
+          if (image.offset + image.length > block.size())
+            throw std::out_of_range("Image exceeds its compressed block");
+          images.emplace(image.source, decode_image(image.format, block.data() + image.offset, image.length));
+          continue;
+         }
+        buffer.resize(image.length);
+        file.seekg(image.offset);
+        file.read(buffer.data(), image.length);
+        images.emplace(image.source, decode_image(image.format, buffer.data(), image.length));
+       }
+     }
+    return ret;
    }
 
+
  }
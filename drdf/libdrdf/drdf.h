@@ -19,7 +19,10 @@
 
 #include <array>
 #include <cstdint>
+#include <fstream>
 #include <map>
+#include <stdexcept>
+#include <string>
 #include <vector>
 #include <uuid/uuid.h>
 
@@ -67,6 +70,15 @@ namespace drdf
     Au16, /*< Amplitude, 16 bit unsigned. */
     Au16Tu16, /*< Amplitude, 16 bit unsigned and Timestamp, 16 bit unsigned. */
     Af32Tf32, /*< Amplitude, 32 bit float and Timestamp, 32 bit float. */
+    SparseAf32Tf32, /*< Af32Tf32 storing only the non-empty pixels, decoded to Af32Tf32 when read. */
+   };
+
+/** Compression of ZDAT (one image) and ZEVT (all the images of an event) chunks.
+    Compressed chunks are expanded transparently by @ref drdf::read .*/
+  enum codec_t : uint8_t
+   {
+    Zlib = 1, /*< zlib stream. */
+    Lzma = 2, /*< xz stream. */
    };
 
   struct __attribute__ ((packed)) ifmt_t
@@ -112,6 +124,16 @@ namespace drdf
     static constexpr ifmttype_t fmttype = Af32Tf32;
    };
 
+/** Record of a sparse image: @c index is the position of the pixel in the flattened image.
+    Pixels without a record are empty (amplitude 0, time NaN).*/
+  struct pixtype_SparseAf32Tf32_t
+   {
+    uint32_t index;
+    float amplitude;
+    float time;
+    static constexpr ifmttype_t fmttype = SparseAf32Tf32;
+   };
+
 /** Typeless image. Users should use @c image_t<T> instead. */
   class image_base_t
    {
@@ -203,6 +225,44 @@ namespace drdf
    };
 
 
+/** Receives the contents of a file in the order they are stored, see @ref drdf::read(uri_t, reader_t&) .*/
+  class reader_t
+   {
+    public:
+    virtual ~reader_t() {}
+    virtual void start_run(const run_uuid_t&) = 0;
+    virtual void set_georef(const uri_t&) = 0;
+    virtual void start_event(eventid_t) = 0;
+/** @p img is decoded to a dense image and can be moved from.*/
+    virtual void add_image(const sourceid_t&, image_base_t&& img) = 0;
+   };
+
+/** Writes a file chunk by chunk, in the order of the calls, without keeping its contents in memory.*/
+  class writer_t
+   {
+    public:
+/** Opens @p fname . Af32Tf32 images with less than @p sparse_density non-empty pixels are stored
+    as SparseAf32Tf32 (0 disables it).*/
+    writer_t(uri_t fname, float sparse_density = 0.5f);
+    writer_t(const writer_t&) = delete;
+    writer_t& operator = (const writer_t&) = delete;
+    void start_run(const run_uuid_t&);
+    void set_georef(const uri_t&);
+    void start_event(eventid_t);
+/** Writes an image with format @p fmt , @p pxls is assumed to point to @p fmt.size() bytes.*/
+    void add_image(const sourceid_t&, const ifmt_t& fmt, const void* pxls);
+/** Writes the end of the file and closes it. A file destroyed without close() is left incomplete.*/
+    void close();
+    private:
+    void write_chunk(const char*, uint32_t, const void*);
+    private:
+    uri_t m_fname;
+    std::ofstream m_file;
+    checksum_t m_crc;
+    float m_sparse_density;
+    std::vector<pixtype_SparseAf32Tf32_t> m_records;
+   };
+
 /** Detector Response Data Format class
 
     This class provides methods for reading a drdf file into dictionary type structures
@@ -309,11 +369,26 @@ namespace drdf
     public:
     drdf();
 
-    /** Writes the current contentes of this class to @p fname .*/
-    void write(uri_t fname);
+    /** Writes the current contentes of this class to @p fname .
+        If @p index is true, the sidecar index @p fname.idx is written as well.
+        Af32Tf32 images with less than @p sparse_density non-empty pixels are stored
+        as SparseAf32Tf32 (0 disables it).*/
+    void write(uri_t fname, bool index = false, float sparse_density = 0.5f);
 
     /** Reads @p fname into a new instance of this class.*/
     static drdf read(uri_t fname);
+
+    /** Reads @p fname passing its runs, events and images to @p reader in file order.
+        Nothing is kept in memory besides the file itself.*/
+    static void read(uri_t fname, reader_t& reader);
+
+    /** Reads only the events listed in @p events from @p fname , seeking them through
+        the sidecar index @p fname.idx . The index is regenerated if missing or stale.
+        The file checksum is not verified in this case.*/
+    static drdf read(uri_t fname, const std::vector<eventid_t>& events);
+
+    /** Scans @p fname and writes its sidecar index @p fname.idx .*/
+    static void write_index(uri_t fname);
 /*
     template <typename Pixtype>
     const_iterator<Pixtype> begin() const
@@ -420,11 +495,38 @@ namespace drdf
      }
 
     private:
-    static std::array<checksum_t, 256> generate_crc_table();
+    struct index_image_t
+     {
+      sourceid_t source;
+      ifmt_t format;
+      uint64_t offset;
+      uint32_t length;
+      uint64_t block_offset;
+      uint32_t block_length;
+     };
+
+    struct index_event_t
+     {
+      uint32_t run;
+      eventid_t event;
+      uint64_t begin;
+      uint64_t end;
+      std::vector<index_image_t> images;
+     };
+
+    struct index_t
+     {
+      uint64_t size;
+      checksum_t crc;
+      std::vector<std::pair<run_uuid_t, uri_t>> runs;
+      std::vector<index_event_t> events;
+     };
+
+    static bool load_index(const uri_t&, index_t&);
 
-    static checksum_t crc32(checksum_t, const char*, const char*);
+    static index_t scan_index(const uri_t&);
 
-    static checksum_t write_chunk(std::ofstream&, const char*, uint32_t, const void*, checksum_t);
+    static void save_index(const uri_t&, const index_t&);
 
     private:
     file_map_t m_runs;
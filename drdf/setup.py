@@ -15,7 +15,7 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 #
 
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 import pathlib
 
 here = pathlib.Path(__file__).parent.resolve()
@@ -23,6 +23,16 @@ here = pathlib.Path(__file__).parent.resolve()
 # Get the long description from the README file
 long_description = (here / 'README.md').read_text(encoding='utf-8')
 
+# Optional wrapper of libdrdf used by DRDF.read and DRDF.write, the package falls back to
+# pure Python if it cannot be built (no compiler, or missing uuid, zlib or lzma headers)
+libdrdf = Extension(
+    'drdf._libdrdf',
+    sources=['drdf/_libdrdf.cpp', 'libdrdf/drdf.cpp'],
+    include_dirs=['libdrdf'],
+    libraries=['uuid', 'z', 'lzma'],
+    extra_compile_args=['-std=c++17', '-O2'],
+    optional=True,
+)
 
 setup(
     name='drdf',  # Required
@@ -34,6 +44,7 @@ setup(
     author='Nicolo Tosi',  # Optional
     author_email='nicolo.tosi@bo.infn.it',  # Optional
     packages=find_packages(where='.'),  # Required
+    ext_modules=[libdrdf],
     python_requires='>=3.6, <4',
     install_requires=[''],  # Optional
 )
@@ -37,6 +37,11 @@ img2 = drdf.Image(24, 24, drdf.Fmtcode.Au16Tu16)
 img2.pixels = np.random.randint(0, 65536, size=(24,24,2), dtype=np.uint16)
 testfile.add_image("CAM_NORTH_X05_Y02",img2)
 
+img3 = drdf.Image(24, 24, drdf.Fmtcode.Af32Tf32)
+img3.pixels[...,1] = np.nan                               #empty pixels: amplitude 0, time NaN
+img3.pixels[3,5] = (12., 4.5)                             #mostly empty, written as SparseAf32Tf32
+testfile.add_image("CAM_NORTH_X05_Y03",img3)
+
 testfile.start_event(np.random.randint(0, 65536))
 
 testfile.write('foo.img')
@@ -62,6 +62,12 @@ int main(int argc, char** argv)
       std::cout << "Looking at event: " << eventid << std::endl;
       for (auto img : event.second)
        {
+        if (img.second.format().pixelfmt != Af32Tf32) //SparseAf32Tf32 images are expanded by drdf::read
+         {
+          std::cerr << "Skipping sensor " << img.first << ": unsupported pixel format "
+                    << int(img.second.format().pixelfmt) << std::endl;
+          continue;
+         }
         auto image = static_cast<const image_t<pixtype_Af32Tf32_t>&>(img.second);
         int sx = image.width();
         int sy = image.height();
@@ -134,6 +140,12 @@ int main(int argc, char** argv)
       for (auto img : event.second)
        {
        
+        if (img.second.format().pixelfmt != Af32Tf32) //SparseAf32Tf32 images are expanded by drdf::read
+         {
+          std::cerr << "Skipping sensor " << img.first << ": unsupported pixel format "
+                    << int(img.second.format().pixelfmt) << std::endl;
+          continue;
+         }
         auto image = static_cast<const image_t<pixtype_Af32Tf32_t>&>(img.second);
         int sx = image.width();
         int sy = image.height();
@@ -6,40 +6,170 @@ import numpy as np
 import argparse
 import sys
 import os
+import collections
+import re
 import ROOT
+import matplotlib
+matplotlib.use('Agg')                    #plots are only saved to file, also from the worker processes
 from matplotlib import pyplot as plt
 from scipy import optimize
+from concurrent.futures import ProcessPoolExecutor
 
-def read_file(drdf_file):
-    testfile = drdf.DRDF()
-    testfile.read(drdf_file)
-    event_list = []
-    for run, rundata in testfile.runs.items():
-      ev_arr = np.empty(0)
-      event_amp = np.empty(0)
-      for event, eventdata in rundata.items():
-        print('Event', event, 'with', len(eventdata), 'images')
-        cam_amp = np.empty(0)
-        px_amp = np.empty(0)
-        for src, image in eventdata.items():
-          amp = image.pixels[:,:,0].flatten()      #(32,32)matrix reshaped into 1d array of lenght 1024
-          px_amp = np.append(px_amp,amp)
-          cam_amp = np.append(cam_amp,np.sum(amp))                #put together all cameras  px_amp.shape(1024*76,)=(77824,)
-        ev_arr = np.append(ev_arr,event)
-        event_amp = np.append(event_amp,np.sum(cam_amp))
-        event_list.append((event, px_amp))
-    events = np.column_stack((ev_arr,event_amp))
-    return event_list, events                         
+CACHE_KEYS = ['events', 'cameras', 'camera_amp', 'event_amp', 'amplitude', 'time']
+
+def cache_prefix(drdf_file, cache_dir=None):
+    """cache files of drdf_file, named after its size and modification time"""
+    stat = os.stat(drdf_file)
+    folder = cache_dir or os.path.dirname(os.path.abspath(drdf_file))
+    return os.path.join(folder, '{0}.{1}.{2}'.format(os.path.basename(drdf_file), stat.st_size, stat.st_mtime_ns))
+
+def load_cache(prefix):
+    """arrays saved by save_cache, None if any is missing. Images are memory-mapped"""
+    if not all(os.path.exists(prefix + '.' + key + '.npy') for key in CACHE_KEYS):
+        return None
+    return {key: np.load(prefix + '.' + key + '.npy', mmap_mode='r' if key in ('amplitude', 'time') else None) for key in CACHE_KEYS}
+
+def save_cache(prefix, data):
+    folder, name = os.path.split(prefix)
+    old_cache = re.compile(re.escape(name.rsplit('.', 2)[0]) + r'\.\d+\.\d+\.(' + '|'.join(CACHE_KEYS) + r')\.npy')
+    for old in os.listdir(folder or '.'):       #caches of older versions of the same file, not of other files with the same prefix
+        if old_cache.fullmatch(old) and not old.startswith(name + '.'):
+            os.remove(os.path.join(folder, old))
+    for key in CACHE_KEYS:              #'time' is written last: a partial cache is never loaded
+        np.save(prefix + '.' + key + '.tmp.npy', data[key])
+        os.replace(prefix + '.' + key + '.tmp.npy', prefix + '.' + key + '.npy')
+
+def read_file(drdf_file, cache=False, cache_dir=None):
+    """amplitude and time of every camera of every event, as (events, cameras, 32, 32) arrays,
+       with the per camera (events, cameras) and per event (events,) amplitude sums"""
+    if cache:
+        prefix = cache_prefix(drdf_file, cache_dir)
+        data = load_cache(prefix)
+        if data is not None:
+            return data
+    with drdf.DRDFReader(drdf_file) as reader:
+        keys = [(run, event) for run, rundata in reader.runs.items() for event in rundata]
+        cameras = list(collections.OrderedDict.fromkeys(src for run, event in keys for src in reader.runs[run][event]))
+        column = {src: i for i, src in enumerate(cameras)}
+        shape = (0, 0)
+        if keys and cameras:
+            run, event = keys[0]
+            offset, length, x, y = next(iter(reader.runs[run][event].values()))[:4]
+            shape = (x, y)
+        amplitude = np.zeros((len(keys), len(cameras)) + shape, dtype='float32')
+        time = np.full((len(keys), len(cameras)) + shape, np.nan, dtype='float32')
+        for i, (run, event, images) in enumerate(reader.items()):
+            for src, image in images.items():
+                amplitude[i, column[src]] = image.pixels[...,0]
+                time[i, column[src]] = image.pixels[...,1]
+    camera_amp = amplitude.sum(axis=(2,3), dtype='float64')
+    data = {'events': np.array([event for run, event in keys], dtype='uint32'),
+            'cameras': np.array(cameras, dtype=str),
+            'camera_amp': camera_amp,
+            'event_amp': camera_amp.sum(axis=1),
+            'amplitude': amplitude,
+            'time': time}
+    print('Read', len(keys), 'events with', len(cameras), 'cameras')
+    if cache:
+        save_cache(prefix, data)
+    return data
     
-def load_edep_data(inFile, treekey, evn):  #arguments are: filename, camera, event
-    treename = treekey.GetName()
-    tree = inFile.Get(treename)             #select camera
-    tree.GetEntry(evn)                      #select event
-    energy_dep = 0
-    for hit in tree.Event.SegmentDetectors["LArHit"]:
-      energy_dep+=hit.GetEnergyDeposit()       
-    return energy_dep            #output: information on photons 
-            
+EDEP_TREE = 'EDepSimEvents'
+EDEP_EXPR = ('double energy = 0.;'                   #energy deposited in the LAr hit segments of an event
+             'auto hits = Event.SegmentDetectors.find("LArHit");'
+             'if (hits != Event.SegmentDetectors.end())'
+             '  for (const auto& hit : hits->second) energy += hit.GetEnergyDeposit();'
+             'return energy;')
+
+def load_edep_energy(edep_file, start, stop, threads=0, cache_dir=None):
+    """deposited energy (MeV) of the events start ... stop-1, read in one pass with RDataFrame.
+       threads > 0 enables ROOT implicit multithreading. With cache_dir, the result is saved there
+       and reused as long as the edep file and the event range are the same"""
+    if cache_dir:
+        stat = os.stat(edep_file)
+        cache = os.path.join(cache_dir, 'edep_{0}.{1}.{2}.{3}_{4}.npy'.format(os.path.basename(edep_file), stat.st_size, stat.st_mtime_ns, start, stop))
+        if os.path.exists(cache):
+            return np.load(cache)
+    if threads > 0:
+        ROOT.EnableImplicitMT(threads)
+        df = ROOT.RDataFrame(EDEP_TREE, edep_file)
+        df = df.Define('entry', 'rdfentry_').Filter('entry >= {0} && entry < {1}'.format(start, stop))     #Range is not available with implicit MT
+        columns = df.Define('edep', EDEP_EXPR).AsNumpy(['entry', 'edep'])
+        energy = columns['edep'][np.argsort(columns['entry'], kind='stable')]          #threads return the entries out of order
+    else:
+        df = ROOT.RDataFrame(EDEP_TREE, edep_file).Range(start, stop)
+        energy = df.Define('edep', EDEP_EXPR).AsNumpy(['edep'])['edep']
+    energy = np.asarray(energy, dtype='float64')
+    if cache_dir:
+        np.save(cache + '.tmp.npy', energy)
+        os.replace(cache + '.tmp.npy', cache)
+    return energy
+
+_figures = {}                            #figures of this process, reused for every event it plots
+
+def camera_figure(shape):
+    """single camera figure: the mesh and the colorbar are updated for each camera"""
+    if ('camera', shape) not in _figures:
+      fig, ax = plt.subplots()
+      mesh = ax.pcolormesh(np.zeros(shape))
+      fig.colorbar(mesh)
+      _figures[('camera', shape)] = fig, ax, [mesh]
+    return _figures[('camera', shape)]
+
+def grid_figure(ncameras, shape):
+    """all the cameras of an event in one figure, with a common color scale"""
+    if ('grid', ncameras, shape) not in _figures:
+      ncols = int(np.ceil(np.sqrt(ncameras)))
+      nrows = int(np.ceil(ncameras / ncols))
+      fig, axes = plt.subplots(nrows, ncols, figsize=(1.6*ncols, 1.6*nrows), squeeze=False)
+      meshes = []
+      for i, ax in enumerate(axes.flat):
+        ax.set_axis_off()
+        if i < ncameras:
+          meshes.append(ax.pcolormesh(np.zeros(shape)))
+          ax.set_title("camera "+str(i+1), fontsize=6)
+      fig.colorbar(meshes[0], ax=axes.ravel().tolist())
+      _figures[('grid', ncameras, shape)] = fig, axes, meshes
+    return _figures[('grid', ncameras, shape)]
+
+def plot_cameras(ev, amp_calo, cam_path):
+    """one png per camera in cam_path"""
+    fig, ax, (mesh,) = camera_figure(amp_calo.shape[1:])
+    for i in range(len(amp_calo)):                            #separate each camera
+      amp1 = amp_calo[i]
+      mesh.set_array(amp1.ravel())
+      mesh.set_clim(amp1.min(), amp1.max())
+      ax.set_title("event "+str(ev)+" - camera "+str(i+1))
+      fig.savefig(cam_path+"/cam"+str(i+1)+".png")
+    return ev
+
+def plot_grid(ev, amp_calo, cam_path):
+    """all the cameras of the event in cam_path.png"""
+    fig, axes, meshes = grid_figure(len(amp_calo), amp_calo.shape[1:])
+    vmin, vmax = amp_calo.min(), amp_calo.max()
+    for mesh, amp1 in zip(meshes, amp_calo):
+      mesh.set_array(amp1.ravel())
+      mesh.set_clim(vmin, vmax)
+    fig.suptitle("event "+str(ev))
+    fig.savefig(cam_path+".png")
+    return ev
+
+def plot_events(plot, events, amplitude, evn_path, workers=None):
+    """plot the events with a pool of processes, a few events are queued for each of them"""
+    if plot is plot_cameras:
+      for ev in events:
+        if not os.path.exists(evn_path+'/event'+str(ev)):
+          os.mkdir(evn_path+'/event'+str(ev))
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+      pending = collections.deque()
+      for ev, amp_calo in zip(events, amplitude):                #loop over events
+        if len(pending) >= 2*workers:                            #do not copy all the images to the queue at once
+          print("Event", pending.popleft().result())
+        pending.append(pool.submit(plot, ev, np.asarray(amp_calo), evn_path+'/event'+str(ev)))
+      while pending:
+        print("Event", pending.popleft().result())
+
 if __name__ == '__main__':
    
     drdf_calo = sys.argv[1]
@@ -47,51 +177,32 @@ if __name__ == '__main__':
     output_path = sys.argv[3]
     event_number = int(sys.argv[4])      #number of total jobs
     start_evn = int(sys.argv[5])
-    plot_cameras = (sys.argv[6]).lower() in ['yes']
+    plot_mode = (sys.argv[6]).lower()       #yes: one image per camera, grid: one image per event
+    use_cache = len(sys.argv) > 7 and (sys.argv[7]).lower() in ['yes']      #keep the images in .npy files next to the drdf file
+    edep_threads = int(sys.argv[8]) if len(sys.argv) > 8 else 0             #threads reading the edepsim file
+    plot_workers = int(sys.argv[9]) if len(sys.argv) > 9 else None          #processes plotting the cameras, default one per cpu
     
     if not os.path.exists(output_path):
         os.mkdir(output_path)
 #---------- read drdf file ------------------------------------------------------------------------------    
     print('Reading drdf file')
-    event_list, event_array=read_file(drdf_calo)    
-    
-    event_num = event_array[:,0]
-    event_amp = event_array[:,1]
+    data = read_file(drdf_calo, cache=use_cache)
+
+    event_num = data['events']
+    event_amp = data['event_amp']
 
     #----- plot photon amplitude distribution for each camera -----------   
-    #ATTENTION: this step may take a long time    
-    if plot_cameras:
+    #ATTENTION: this step may take a long time, the grid mode is faster
+    if plot_mode in ['yes', 'grid']:
       evn_path = output_path+'/cameras_folder'
       if not os.path.exists(evn_path):        #create 
         os.mkdir(evn_path)
-      npix = 1024
-      for ev, amp_calo in event_list:           #loop over events
-        print("Event",ev)
-        cam_path = evn_path+'/event'+str(ev)
-        if not os.path.exists(cam_path):        #create 
-          os.mkdir(cam_path)            
-        for i in range(int(amp_calo.size/npix)):                            #separate each camera
-          amp1 = np.reshape(amp_calo[npix*i:npix*(i+1)],(32,32))
-          plt.pcolormesh(amp1)
-          plt.colorbar()
-          plt.title("event "+str(ev)+" - camera "+str(i+1))
-          plt.savefig(cam_path+"/cam"+str(i+1)+".png")
-          plt.close()
+      plot_events(plot_cameras if plot_mode == 'yes' else plot_grid, event_num, data['amplitude'], evn_path, plot_workers)
 
 #--------- read edepsim ----------------------------------------------------------------------------------
     print('Reading edepsim file')
-    inFile = ROOT.TFile.Open(edep_file, "READ")         #file sensors.root
-    klist = inFile.GetListOfKeys()
     stop = event_number + start_evn      
-    event_energy_dep = np.empty(0)
-    for evn in range(start_evn,stop):
-       print('Event',evn)
-       treeEv = inFile.Get(klist.Last().GetName())     #opening tree of first sensor to get idEvent
-       treeEv.GetEntry(evn)                            #select event
-       key = klist[2]
-       if key.GetName() == 'EDepSimEvents':
-           energy_dep= load_edep_data(inFile, key, evn)
-           event_energy_dep = np.append(event_energy_dep,energy_dep)    
+    event_energy_dep = load_edep_energy(edep_file, start_evn, stop, edep_threads, output_path if use_cache else None)
     
     #compare number of photons versus event energy
     plt.plot(event_energy_dep,event_amp,'.')
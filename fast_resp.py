@@ -3,15 +3,22 @@
 import os
 import tempfile
 os.environ["MPLCONFIGDIR"] = tempfile.gettempdir()
-from scipy.stats import norm 
 import numpy as np
-import ROOT
+try:
+    import ROOT
+except ImportError:                          #only needed to read sensors.root, the response itself is numpy only
+    ROOT = None
 import sys
 import uuid
 import xml.etree.ElementTree as ET
 import drdf
+import jobstats
 import time
 import argparse
+import hashlib
+import multiprocessing
+import itertools
+import json
 
 def import_configuration(configfile):
     """reads configuration parameters from xml file and returns a dictionary"""
@@ -24,125 +31,309 @@ def import_configuration(configfile):
         configdict[name] = value
     return configdict
 
-def load_sensor_data(inFile, treekey, evn):  #arguments are: filename, camera, event
-    treename = treekey.GetName()
-    tree = inFile.Get(treename)             #select camera
-    #print(treename)
-    #sensor_data = np.empty((0,5),float)
-    tree.GetEntry(evn)                      #select event
-    en = np.array(tree.energy)
-    t = np.array(tree.time)
-    x = np.array(tree.x)
-    y = np.array(tree.y)
-    z = np.array(tree.z)
-    sensor_data = np.vstack((en,t,x,y,z)).T
-    return sensor_data, treename            #output: information on photons + camera name
-
-def assign_channel(photons, geom):          #arguments: sensor_data, CONFIG     
+GEOMETRY = ['cellsize', 'celledge', 'matrix', 'zplane']     #parameters of assign_channel, the same for all configurations of a scan
+
+def scan_configurations(config, configfiles=(), grid=()):
+    """configurations of a parameter scan: config and the configfiles, each with every combination of the grid values (items 'name=value1,value2,...')"""
+    configs = [config] + [import_configuration(f) for f in configfiles]
+    for f, c in zip(configfiles, configs[1:]):
+        missing = [name for name in GEOMETRY if name not in c]
+        if missing:
+            raise ValueError(f + ' has no ' + ', '.join(missing))
+    names = []
+    values = []
+    for item in grid:
+        name, _, vals = item.partition('=')
+        if name not in config:
+            raise ValueError('unknown parameter in --grid: ' + name)
+        names.append(name)
+        values.append([eval(v, {"__builtins__": {}}, {}) for v in vals.split(',')])
+    configs = [dict(c, **dict(zip(names, combo))) for c in configs for combo in itertools.product(*values)]
+    for c in configs:
+        for name in GEOMETRY:
+            if c.get(name) != config.get(name):
+                raise ValueError('all the configurations of a scan must have the same ' + name)
+    return configs
+
+def scan_run(run_uuid, config):
+    """run id of a configuration of a scan: the same run id and parameters give the same random numbers"""
+    return uuid.uuid5(run_uuid, json.dumps(config, sort_keys=True))
+
+def scan_path(wfile, k):
+    base, ext = os.path.splitext(wfile)
+    return base + '_scan' + str(k) + ext
+
+SENSOR_BRANCHES = ['time', 'x', 'y', 'z']     #photon energy is not needed by the response
+READ_BLOCK = 64                               #events read at once from each camera tree
+
+def read_sensor_block(inFile, treename, start, stop):  #arguments are: file, camera, event range
+    """reads the photons of events [start, stop) of a camera tree into flat columns plus per-event offsets"""
+    data = ROOT.RDataFrame(treename, inFile).Range(start, stop).AsNumpy(SENSOR_BRANCHES)
+    sizes = np.fromiter((len(v) for v in data['time']), dtype=np.int64, count=stop - start)
+    offsets = np.zeros(stop - start + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])                   #photons of event start+i are offsets[i]:offsets[i+1]
+    columns = np.empty((len(SENSOR_BRANCHES), offsets[-1]))       #one contiguous row per quantity
+    if offsets[-1]:
+        for row, branch in zip(columns, SENSOR_BRANCHES):
+            np.concatenate(data[branch], out=row)
+    return columns, offsets
+
+@jobstats.timed('read_root')
+def load_block(inFile, klist, start, stop):  #arguments are: file, list of keys, event range
+    """reads events [start, stop) of every camera, opening each tree once"""
+    cameras = [key.GetName() for key in klist if key.GetName() != 'commit_hash']
+    idEvent = ROOT.RDataFrame(klist.Last().GetName(), inFile).Range(start, stop).AsNumpy(['idEvent'])['idEvent']
+    return {'start': start, 'stop': stop, 'idEvent': idEvent,
+            'cameras': {name: read_sensor_block(inFile, name, start, stop) for name in cameras}}
+
+@jobstats.timed('load_sensor_data')
+def load_sensor_data(block, camera, evn):  #arguments are: block of events, camera, event
+    columns, offsets = block['cameras'][camera]
+    i = evn - block['start']
+    sensor_data = columns[:, offsets[i]:offsets[i + 1]].T      #view, no copy: one row per photon with time, x, y, z
+    return sensor_data, camera            #output: information on photons + camera name
+
+def load_event_data(block, evns):  #arguments are: block of events, list of events
+    """loads the photons of all cameras for the events in evns, with a camera index column"""
+    columns = []
+    cams = []
+    cameras = list(block['cameras'])
+    for i, evn in enumerate(evns):
+        for j, camera in enumerate(cameras):
+            sensor_data, sensor_name = load_sensor_data(block, camera, evn)
+            columns.append(sensor_data.T)
+            cams.append(np.full(len(sensor_data), i * len(cameras) + j))    #camera j of the i-th event of the batch
+    photons = np.hstack(columns).T if columns else np.empty((0,4))          #one contiguous array per quantity
+    cam = np.concatenate(cams) if cams else np.empty(0, dtype=int)
+    return photons, cam, cameras            #output: photons of every camera + camera index of each photon + camera names
+
+def geometry_buffers(n, dtype='float64'):
+    """scratch arrays used by assign_channel for a camera of n photons"""
+    return {'val': np.empty(n, dtype=dtype), 'keep': np.empty(n, dtype=bool), 'cut': np.empty(n, dtype=bool)}
+
+GEOM_BUF = {}                               #reused by assign_channel across cameras and events
+
+@jobstats.timed('assign_channel')
+def assign_channel(photons, geom, dtype=None, buf=None, cam=None):          #arguments: sensor_data, CONFIG, optional float type, scratch buffers and camera index
     """assigns photon to corresponding matrix channel"""    
     shape = geom['matrix']                  #SiPM matrix is 32x32
-    nch = shape[0] * shape[1]               #number of channels 
-    xside = shape[0] * (geom['cellsize'] + 2 * geom['celledge'])/ 2         #find coordinates of matrix edge 
-    yside = shape[1] * (geom['cellsize'] + 2 * geom['celledge'])/ 2         #wrt the centre of the sensor
-    
-    # ---- verify photons hit active areas and apply cuts ----
-    z_thres = np.where(np.isclose(photons[:,4], geom['zplane']))
-    active_areaX = np.where((np.abs(photons[:,2][z_thres])>=0) & (np.abs(photons[:,2][z_thres]) <= xside))
-    cut1 = np.intersect1d(z_thres,active_areaX)
+    pitch = geom['cellsize'] + 2 * geom['celledge']
+    xside = shape[0] * pitch / 2            #find coordinates of matrix edge 
+    yside = shape[1] * pitch / 2            #wrt the centre of the sensor
+    period = geom['cellsize'] + geom['celledge']
+    t, x, y, z = photons[:,0], photons[:,1], photons[:,2], photons[:,3]
+    if dtype is not None:
+        t, x, y, z = (np.asarray(col, dtype=dtype) for col in (t, x, y, z))
+    n = x.size
+    if buf is None:
+        buf = {}
+    if 'val' not in buf or buf['val'].size < n or buf['val'].dtype != x.dtype:
+        buf.update(geometry_buffers(n, x.dtype))
+    val, keep, cut = buf['val'][:n], buf['keep'][:n], buf['cut'][:n]
     
-    xedge = np.remainder(np.abs(photons[:,2][cut1]),(geom['cellsize'] + geom['celledge']))        
-    x_thres = np.where((xedge >= geom['celledge']) & (xedge<=(geom['cellsize']+geom['celledge'])))
-    cut2 = np.intersect1d(cut1,x_thres) 
+    # ---- verify photons hit active areas and apply cuts, all in the same mask ----
+    np.subtract(z, geom['zplane'], out=val)                                     #same tolerance as np.isclose
+    np.abs(val, out=val)
+    np.less_equal(val, 1e-08 + 1e-05 * abs(geom['zplane']), out=keep)
+    for coord, side in ((x, xside), (y, yside)):
+        np.abs(coord, out=val)
+        keep &= np.less_equal(val, side, out=cut)                               #active area
+        np.remainder(val, period, out=val)
+        keep &= np.greater_equal(val, geom['celledge'], out=cut)                #cell edges
+        keep &= np.less_equal(val, geom['cellsize'] + geom['celledge'], out=cut)
     
-    active_areaY = np.where((np.abs(photons[:,3][cut2])>=0) & (np.abs(photons[:,3][cut2]) <= yside))   
-    cut3 = np.intersect1d(cut2,active_areaY)    
-                                                  
-    yedge = np.remainder(np.abs(photons[:,3][cut3]),(geom['cellsize'] + geom['celledge']))           
-    y_thres = np.where((yedge >= geom['celledge']) & (yedge<=(geom['cellsize']+geom['celledge'])))
-    cut4 = np.intersect1d(cut3,y_thres)
-    
-    cell_x = np.floor_divide(photons[:,2][cut4],(geom['cellsize'] + 2 * geom['celledge'])) + (shape[0] / 2)
-    cell_y = np.floor_divide(-photons[:,3][cut4],(geom['cellsize'] + 2 * geom['celledge'])) + (shape[1] / 2)
-    time = photons[:,1][cut4]
+    time = t[keep]
+    cell_x = np.floor_divide(x[keep], pitch) + (shape[0] / 2)
+    cell_y = np.floor_divide(-y[keep], pitch) + (shape[1] / 2)
     ch = cell_y * shape[0] + cell_x         #each channel identified by a SINGLE NUMBER from 0 to 1023
+    if cam is not None:                     #photons of several cameras: channel of camera k becomes k*1024 + ch
+        nch = shape[0] * shape[1]
+        inside = (ch >= 0) & (ch < nch)
+        time = time[inside]
+        ch = cam[keep][inside] * nch + ch[inside]
     return time, ch
 
-def count_photons(time, ch, config ):                                            #argument: time, photons (a single array), config
+def group_by_channel(time, ch, config, ncam=None):                              #arguments: time, channel (arrays from assign_channel), config
+    """sorts photons by channel; returns hit channels, photons per channel, photons within integration time and first arrival"""
+    shape = config['matrix']
+    nch = shape[0] * shape[1] * (ncam or 1)
+    inside = (ch >= 0) & (ch < nch)                      #photons falling outside the matrix are not counted
+    chn = ch[inside].astype(np.intp)
+    t = time[inside]
+    order = np.argsort(chn, kind='stable')               #photons of the same channel become contiguous
+    chn = chn[order]
+    t = t[order]
+    counts = np.bincount(chn, minlength=nch)
+    hit = np.flatnonzero(counts)                         #channels reached by at least one photon
+    tmin = np.full(nch, np.nan)
+    if hit.size == 0:
+        return hit, counts, counts, tmin
+    starts = np.cumsum(counts)[hit] - counts[hit]        #index of the first photon of each hit channel
+    tmin[hit] = np.minimum.reduceat(t, starts)           #arrival time of first photon
+    in_window = t < np.repeat(tmin[hit], counts[hit]) + config['integrTime']     #photons which arrived within integrationTime (e.g. 500ns)
+    t_num = np.bincount(chn[in_window], minlength=nch)
+    return hit, counts, t_num, tmin
+
+def new_image(config, out=None, ncam=None):
+    """returns an empty (amplitude, time) image, or a stack of ncam images, filling out if given"""
+    shape = config['matrix']
+    if out is None:
+        out = np.empty(((ncam,) if ncam else ()) + (shape[0], shape[1], 2), dtype='float32')
+    out[...,0] = 0
+    out[...,1] = np.nan
+    return out
+
+def camera_rng(run_uuid, idEvent, camera):         #arguments: run UUID, event id, camera name
+    """random generator of a camera in an event: Philox keyed by the run, counter starting from (event, camera)"""
+    camhash = int.from_bytes(hashlib.blake2b(camera.encode('ascii'), digest_size=8).digest(), 'little')
+    counter = np.array([0, 0, idEvent, camhash], dtype=np.uint64)         #draws only advance the first word
+    return np.random.Generator(np.random.Philox(counter=counter, key=run_uuid.int))
+
+def sipm_response(t_num, rng, config):              #arguments: photons within integration time of each channel, generator, config
+    """amplitude of each channel; all the random numbers of a camera are drawn in three calls"""
+    if config.get('sampling', 'photon') == 'channel':
+        return sipm_response_channel(t_num, rng, config)
+    chan = np.arange(t_num.size)
+    pde_ph = np.bincount(np.repeat(chan, t_num)[rng.random(t_num.sum()) < config['pde127nm']], minlength=chan.size)      #apply the pde over the time-allowed photons
+    cross_ph = np.bincount(np.repeat(chan, pde_ph)[rng.random(pde_ph.sum()) < config['pcross']], minlength=chan.size)    #apply cross-talk over the pde-allowed photons
+    nph = pde_ph + cross_ph
+    gain = np.bincount(np.repeat(chan, nph), weights=rng.normal(0, config['phgain'], nph.sum()), minlength=chan.size)    #gain over photon amp.
+    return nph + gain
+
+def sipm_response_channel(t_num, rng, config):      #arguments: photons within integration time of each channel, generator, config
+    """same distribution as sipm_response, drawing the counts and the total gain of each channel instead of each photon"""
+    pde_ph = rng.binomial(t_num, config['pde127nm'])                 #detected photons
+    cross_ph = rng.binomial(pde_ph, config['pcross'])                #cross-talk photons
+    nph = pde_ph + cross_ph
+    gain = rng.normal(0, config['phgain'] * np.sqrt(nph))            #sum of nph gaussian smearings
+    return nph + gain
+
+def sipm_image(grouped, config, out=None, ncam=None, rngs=None):              #arguments: output of group_by_channel, config
+    """image of the grouped photons with the sipm response of config"""
+    hit, counts, t_num, tmin = grouped
+    img = new_image(config, out, ncam)
+    pix = img.reshape(-1, 2)                             #one (amplitude, time) row per channel
+    shape = config['matrix']
+    nch = shape[0] * shape[1]
+    if rngs is None:                                     #one generator per camera, see camera_rng
+        rngs = [np.random.default_rng()] * (ncam or 1)
+    bounds = np.searchsorted(hit, np.arange(len(rngs) + 1) * nch)      #hit channels of camera k are hit[bounds[k]:bounds[k+1]]
+    for k, rng in enumerate(rngs):
+        c = hit[bounds[k]:bounds[k + 1]]
+        if c.size == 0:
+            continue
+        nph = sipm_response(t_num[c], rng, config)
+        c = c[nph >= 1]                                  #can be seen as threshold
+        pix[c, 0] = nph[nph >= 1]
+        pix[c, 1] = tmin[c]
+    return img
+
+@jobstats.timed('count_photons')
+def count_photons(time, ch, config, out=None, ncam=None, rngs=None):          #argument: time, photons (a single array), config
     """considering pde only for sipm response, for debugging/fast execution"""
-    phlist = []
-    for c in range(1024):
-        ph = np.where(ch==c)               #find all photons that reached channel "c"        
-        if (ph[0].size!=0):                  
-            tmin = np.amin(time[ph])            
-            time_cut = np.where(time[ph]<tmin+config['integrTime'])            #find all photons of the channel which arrived within integrationTime (e.g. 500ns)
-            t_num = np.count_nonzero(time[ph]<tmin+config['integrTime'])        
-            pde_ph = np.count_nonzero(np.random.uniform(0,1,t_num) < config['pde127nm'])      #apply the pde over the time-allowed photons
-            cross_ph = np.count_nonzero(np.random.uniform(0,1,pde_ph) < config['pcross'])     #apply cross-talk over the pde-allowed photons
-            nph = pde_ph + cross_ph + sum(np.random.normal(0,config['phgain'],pde_ph+cross_ph))    #count the resulting number of photons + gain over photon amp.
-           
-            phtimes_pde = time[time_cut[0:pde_ph]]                          #extract from time array arrival times of resulting number of photons 
-            phtimes_cross = time[time_cut[0:cross_ph]]                      #add time of photons added with cross-talk
-            phtimes = np.concatenate((phtimes_pde,phtimes_cross))                     
-            if nph < 1:          #can be seen as threshold 
-                count_result = (0, np.nan)
-            else:
-                count_result = (nph, tmin)                           
-        else:
-            count_result = (0, np.nan)
-        phlist.append(count_result)                                   
-    return phlist
-
-def count_photons_no_cut(time, ch, config ):                                           
+    return sipm_image(group_by_channel(time, ch, config, ncam), config, out, ncam, rngs)
+
+@jobstats.timed('count_photons_no_cut')
+def count_photons_no_cut(time, ch, config, out=None, ncam=None):
     """considers simply the total number of photons reaching each camera"""
-    phlist = []
-    for c in range(1024):
-        ph = np.where(ch==c)               #find all photons that reached channel "c"        
-        if (ph[0].size!=0):                  
-            tmin = np.amin(time[ph])            #arrival time of first photon 
-            nph = time[ph].size              
-            if nph < 1:          #can be seen as threshold 
-                count_result = (0, np.nan)
-            else:
-                count_result = (nph, tmin)                     
-        else:
-            count_result = (0, np.nan)
-        phlist.append(count_result)         
-    return phlist
-
-def ph_num(phlist):
-    pharr = np.asarray(phlist)
-    sum = np.sum(pharr.T[0])
+    hit, counts, t_num, tmin = group_by_channel(time, ch, config, ncam)
+    img = new_image(config, out, ncam)
+    pix = img.reshape(-1, 2)
+    pix[hit, 0] = counts[hit]
+    pix[hit, 1] = tmin[hit]                              #arrival time of first photon
+    return img
+
+def event_tensor(photons, cam, ncam, config, nocut=False, out=None, rngs=None):
+    """runs geometry and counting once over the photons of ncam cameras; returns a (ncam,32,32,2) image tensor"""
+    t_arr, ch = assign_channel(photons, config, buf=GEOM_BUF, cam=cam)
+    jobstats.count('photons', len(photons))
+    jobstats.count('photons_on_sipm', len(t_arr))
+    if nocut:
+        return count_photons_no_cut(t_arr, ch, config, out, ncam)
+    return count_photons(t_arr, ch, config, out, ncam, rngs)
+
+def scan_tensor(photons, cam, ncam, configs, rngs):
+    """event_tensor for several configurations with the same geometry: the channels are assigned once and the photons
+       are grouped once per integration time; returns a (configs,ncam,32,32,2) image tensor"""
+    t_arr, ch = assign_channel(photons, configs[0], buf=GEOM_BUF, cam=cam)
+    jobstats.count('photons', len(photons))
+    jobstats.count('photons_on_sipm', len(t_arr))
+    shape = configs[0]['matrix']
+    out = np.empty((len(configs), ncam, shape[0], shape[1], 2), dtype='float32')
+    grouped = {}
+    with jobstats.timed('count_photons'):
+        for k, config in enumerate(configs):
+            if config['integrTime'] not in grouped:
+                grouped[config['integrTime']] = group_by_channel(t_arr, ch, config, ncam)
+            sipm_image(grouped[config['integrTime']], config, out[k], ncam, rngs[k])
+    return out
+
+def ph_num(img):
+    sum = np.sum(img[...,0], dtype='float64')     #amplitudes of all channels of the camera(s)
     #print("number of ph=",sum)
     return sum
             
-def main_evn(inFile,klist,evn,drdffile):
-         treeEv = inFile.Get(klist.Last().GetName())     #opening tree of first sensor to get idEvent
-         treeEv.GetEntry(evn)                           #select event
-         idEvent = treeEv.idEvent                    
-         drdffile.start_event(idEvent)
-         tot_ph = np.empty(0)
-         for key in klist:                           #loop over cameras (the keys of the list)
-             if key.GetName() != 'commit_hash':
-                 sensor_data, sensor_name= load_sensor_data(inFile, key, evn)
-                 t_arr, sensor_data = assign_channel(sensor_data, CONFIG)           
-                 if (args.nocut):
-                     detected_ph_time = count_photons_no_cut(t_arr, sensor_data, CONFIG)            #list of : nph + timeof first arrival
-                     n_ph = ph_num(detected_ph_time)
-                     tot_ph = np.append(tot_ph,n_ph)
-                     imgshape = CONFIG['matrix']
-                     img = np.asarray(detected_ph_time).reshape(imgshape[0], imgshape[1], 2).astype('float32')   #reshape the list of ph 
-                     image = drdf.Image(img)
-                     drdffile.add_image(sensor_name, image)
-                 else: 
-                     detected_ph_time = count_photons(t_arr, sensor_data, CONFIG)       
-                     n_ph = ph_num(detected_ph_time)
-                     tot_ph = np.append(tot_ph,n_ph)
-                     imgshape = CONFIG['matrix']
-                     img = np.asarray(detected_ph_time).reshape(imgshape[0], imgshape[1], 2).astype('float32')    
-                     image = drdf.Image(img)
-                     drdffile.add_image(sensor_name, image)
-         print("number of ph=",np.sum(tot_ph))
-         return drdffile        
+def main_evn(block,evn):           #evn is a single event or a batch of events, all inside block
+         evns = np.atleast_1d(evn)
+         photons, cam, cameras = load_event_data(block, evns)
+         idEvents = [int(block['idEvent'][evn - block['start']]) for evn in evns]
+         jobstats.count('events', len(evns))
+         ncam = len(evns) * len(cameras)
+         if args.nocut:                                  #no random numbers, the same for all configurations
+             images = event_tensor(photons, cam, ncam, CONFIG, True)[np.newaxis]
+         else:
+             rngs = [[camera_rng(run, idEvent, camera) for idEvent in idEvents for camera in cameras] for run, config in RUNS]     #same random numbers however events are split among jobs
+             images = scan_tensor(photons, cam, ncam, [config for run, config in RUNS], rngs)      #all cameras of all events at once, for each configuration
+         images = images.reshape((len(images), len(evns), len(cameras)) + images.shape[2:])
+         return images, cameras
+
+def init_worker(rootfile, runs, arguments):
+    """opens the input file once in each worker process"""
+    global inFile, klist, CONFIG, args, runid, RUNS
+    RUNS = runs
+    runid, CONFIG = runs[0]
+    args = arguments
+    inFile = ROOT.TFile.Open(rootfile, "READ")
+    klist = inFile.GetListOfKeys()
+
+def process_block(bounds):                  #argument: (first, last) event of the block
+    """processes events [first, last); returns camera names, event ids and a (runs,events,cameras,32,32,2) image tensor"""
+    first, last = bounds
+    block = load_block(inFile, klist, first, last)
+    images = []
+    for evn in range(first, last, args.batch):          #loop over batches of events
+        img, cameras = main_evn(block, range(evn, min(evn + args.batch, last)))
+        images.append(img)
+    return cameras, block['idEvent'], np.concatenate(images, axis=1)
+
+def worker_block(bounds):
+    """process_block in a worker process, also returning the time spent in each stage"""
+    return process_block(bounds), jobstats.take()
+
+@jobstats.timed('drdf_write')
+def write_block(drdffiles, result):
+    """adds the events returned by process_block to the drdf files, one for each run"""
+    cameras, idEvent, images = result
+    for drdffile, run_images in zip(drdffiles, images):
+        for i in range(len(idEvent)):
+            drdffile.start_event(int(idEvent[i]))
+            for camera, img in zip(cameras, run_images[i]):     #cameras without photons give an empty image
+                image = drdf.Image(img)
+                drdffile.add_image(camera, image)
+            print("number of ph=",ph_num(run_images[i]))
+    return drdffiles
+
+def join_runs(parts, wfile):
+    """copies the runs of the parts, one after the other, into wfile and removes the parts"""
+    with drdf.DRDFWriter(wfile) as drdffile:
+        for part in parts:
+            with drdf.DRDFReader(part, verify=False, index=False) as reader:
+                for run, rundata in reader.runs.items():
+                    drdffile.start_run(run)
+                    drdffile.set_georef(reader.georefs.get(run, "DUMMY"))
+                    for event in rundata:
+                        drdffile.copy_event(reader, event, run)
+            os.remove(part)
     
 if __name__ == '__main__':
     
@@ -156,6 +347,15 @@ if __name__ == '__main__':
     parser.add_argument('-e', '--events', help = ' max number of events to be processed')
     parser.add_argument('-s', '--start_event', help = ' starting event')
     parser.add_argument('-i', '--idrun', help ='run identifier (UUID)')         
+    parser.add_argument('-b', '--batch', type=int, default=1, help = ' number of events processed together')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help = ' number of local processes')
+    parser.add_argument('--block', type=int, default=READ_BLOCK, help = ' number of events read at once (unit of work of each process)')
+    parser.add_argument('--compress', choices=['zlib', 'lzma'], help = ' compress the images in the output file')
+    parser.add_argument('--group', action='store_true', help = ' compress all the images of an event together (better ratio, zlib by default)')
+    parser.add_argument('--scan', nargs='+', default=[], metavar='CONFIG', help = ' other response configurations, computed on the same photons (one run each)')
+    parser.add_argument('--grid', action='append', default=[], metavar='NAME=V1,V2', help = ' values of a response parameter to scan (repeat for a grid)')
+    parser.add_argument('--scan-files', action='store_true', help = ' write each configuration of the scan to its own file')
+    parser.add_argument('--stats', help = ' write the time spent in each stage, the photons and the peak memory to this .json file')
     args = parser.parse_args()
 
     configfile = args.configfile
@@ -163,19 +363,15 @@ if __name__ == '__main__':
     wfile = args.outfile
     
     CONFIG = import_configuration(configfile)               #geometrical configuration
-    drdffile = drdf.DRDF()
     if args.idrun:              
         try: 
             runid = uuid.UUID(args.idrun)
         except ValueError:
             print('Insert valid run identifier (UUID format)')
             sys.exit()              
-        drdffile.start_run(runid)
     else:
         runid = uuid.uuid1()
-        drdffile.start_run(runid)
         print('run id: ', runid)
-    drdffile.set_georef("DUMMY")
         
     inFile = ROOT.TFile.Open(fname, "READ")         #file sensors.root
     klist = inFile.GetListOfKeys()
@@ -191,14 +387,52 @@ if __name__ == '__main__':
                 if ((start > nEvents) or (stop > nEvents)): 
                     sys.exit("ERROR. Invalid Jobnumber or Start_event") 
 
-    for evn in range(start, stop):                      #loop over events
-        drdffile=main_evn(inFile,klist,evn,drdffile)
-    drdffile.write(wfile) 
+    try:
+        configs = scan_configurations(CONFIG, args.scan, args.grid)
+    except ValueError as e:
+        sys.exit("ERROR. " + str(e))
+    if len(configs) > 1 and args.nocut:
+        sys.exit("ERROR. --nocut does not depend on the response configuration, it cannot be scanned")
+    scanning = bool(args.scan or args.grid)                 #a scan of a single configuration still uses its parameters and run id
+    RUNS = [(scan_run(runid, c), c) for c in configs] if scanning else [(runid, CONFIG)]
+    if scanning and args.scan_files:
+        files = [scan_path(wfile, k) for k in range(len(RUNS))]
+    elif len(RUNS) == 1:
+        files = [wfile]
+    else:
+        files = [wfile + '.run' + str(k) for k in range(len(RUNS))]       #joined into wfile at the end
+    codec = {'zlib': drdf.Codec.Zlib, 'lzma': drdf.Codec.Lzma}.get(args.compress)
+    drdffiles = []
+    for (run, config), f in zip(RUNS, files):
+        drdffile = drdf.DRDFWriter(f, compress=codec, group=args.group)               #images are written as soon as they are computed
+        drdffile.start_run(run)
+        drdffile.set_georef("DUMMY")
+        drdffiles.append(drdffile)
+    blocks = [(first, min(first + args.block, stop)) for first in range(start, stop, args.block)]
+    if args.jobs > 1:
+        with multiprocessing.get_context('spawn').Pool(args.jobs, initializer=init_worker, initargs=(fname, RUNS, args)) as pool:
+            for result, stats in pool.imap(worker_block, blocks):     #results come back in event order
+                jobstats.add(stats)
+                drdffiles=write_block(drdffiles, result)
+    else:
+        for result in map(process_block, blocks):
+            drdffiles=write_block(drdffiles, result)
+    with jobstats.timed('drdf_write'):
+        for drdffile in drdffiles:
+            drdffile.close() 
+        if len(RUNS) > 1 and not args.scan_files:
+            join_runs(files, wfile)
+    if scanning:
+        with open(wfile + '.scan.json', 'w') as f:                    #configuration of each run
+            json.dump([{'run': str(run), 'file': wfile if not args.scan_files else f_run, 'config': config}
+                       for (run, config), f_run in zip(RUNS, files)], f, indent=2)
     
     #print("img file saved.")
     inFile.Close()
     end_time=time.perf_counter()
     print("--- %s seconds ---" % (end_time - start_time))
+    if args.stats:
+        jobstats.save_report(args.stats, start=start, stop=stop, jobs=args.jobs, batch=args.batch, block=args.block)
 
     #to set up environment
     #export PYTHONPATH=/opt/exp_software/neutrino/PYTHON3_PACKAGES/
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import contextlib
+import collections
+
+STAGES = collections.OrderedDict()           #stage name -> [calls, seconds] in this process
+COUNTERS = collections.OrderedDict()         #counter name -> total in this process
+START = time.perf_counter()
+
+class timed(contextlib.ContextDecorator):
+    """context manager or function decorator adding calls and time spent to the stage name"""
+    def __init__(self, name):
+        self.name = name
+        self.starts = []                     #one entry per nested call
+    def __enter__(self):
+        self.starts.append(time.perf_counter())
+        return self
+    def __exit__(self, *exc):
+        stage = STAGES.setdefault(self.name, [0, 0.])
+        stage[0] += 1
+        stage[1] += time.perf_counter() - self.starts.pop()
+        return False
+
+def count(name, n=1):
+    COUNTERS[name] = COUNTERS.get(name, 0) + n
+
+def take():
+    """stages and counters collected since the last call, to be sent from a worker process to the main one"""
+    stats = {'stages': dict(STAGES), 'counters': dict(COUNTERS)}
+    STAGES.clear()
+    COUNTERS.clear()
+    return stats
+
+def add(stats):
+    """adds the stages and counters of take() in another process to this process"""
+    for name, (calls, seconds) in stats['stages'].items():
+        stage = STAGES.setdefault(name, [0, 0.])
+        stage[0] += calls
+        stage[1] += seconds
+    for name, n in stats['counters'].items():
+        count(name, n)
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10          #bytes on macOS, kB on Linux
+
+def report(**info):
+    """summary of this process (and its terminated children): info, wall time, stages, counters and peak memory"""
+    return dict(info, host=socket.gethostname(), wall_seconds=time.perf_counter() - START,
+                stages={name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in STAGES.items()},
+                counters=dict(COUNTERS), peak_rss_mb=peak_rss_mb(), peak_rss_children_mb=peak_rss_mb(resource.RUSAGE_CHILDREN))
+
+def save_report(fname, **info):
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(report(**info), f, indent=2)
+    os.replace(fname + '.tmp', fname)
+
+def load_report(fname):
+    with open(fname) as f:
+        return json.load(f)
+
+def save_summary(fname, summary):
+    with open(fname, 'w') as f:
+        json.dump(summary, f, indent=2)
+
+def summarize(reports, memory_margin=1.25):
+    """production summary of the job reports: totals and worst job of each stage, rates and memory"""
+    stages = collections.OrderedDict()
+    for job in reports:
+        for name, stage in job['stages'].items():
+            total = stages.setdefault(name, {'calls': 0, 'seconds': 0., 'max_job_seconds': 0.})
+            total['calls'] += stage['calls']
+            total['seconds'] += stage['seconds']
+            total['max_job_seconds'] = max(total['max_job_seconds'], stage['seconds'])
+    counters = collections.OrderedDict()
+    for job in reports:
+        for name, n in job['counters'].items():
+            counters[name] = counters.get(name, 0) + n
+    wall = [job['wall_seconds'] for job in reports]
+    rss = [max(job['peak_rss_mb'], job['peak_rss_children_mb']) for job in reports]
+    events = counters.get('events', 0)
+    summary = {'jobs': len(reports), 'stages': stages, 'counters': counters,
+               'wall_seconds': {'total': sum(wall), 'mean': sum(wall) / len(wall), 'max': max(wall)},
+               'peak_rss_mb': {'mean': sum(rss) / len(rss), 'max': max(rss)},
+               'suggested_request_memory_mb': int(-(-max(rss) * memory_margin // 256) * 256)}     #rounded up to 256 MB
+    if events:
+        summary['seconds_per_event'] = sum(wall) / events
+        summary['events_per_job'] = events / len(reports)
+    return summary
+
+def print_summary(summary):
+    print('Jobs: %d, wall time per job: mean %.1f s, max %.1f s' % (summary['jobs'], summary['wall_seconds']['mean'], summary['wall_seconds']['max']))
+    total = sum(stage['seconds'] for stage in summary['stages'].values()) or 1.
+    for name, stage in summary['stages'].items():
+        print('  %-18s %12d calls %10.2f s %5.1f%%  (worst job %.2f s)' % (name, stage['calls'], stage['seconds'], 100 * stage['seconds'] / total, stage['max_job_seconds']))
+    for name, n in summary['counters'].items():
+        print('  %-18s %12d' % (name, n))
+    if 'seconds_per_event' in summary:
+        print('Seconds per event: %.3f (%.0f events per job)' % (summary['seconds_per_event'], summary['events_per_job']))
+    print('Peak memory per job: mean %.0f MB, max %.0f MB -> request_memory = %d' % (summary['peak_rss_mb']['mean'], summary['peak_rss_mb']['max'], summary['suggested_request_memory_mb']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Production summary of the job reports of fast_resp')
+    parser.add_argument('reports', nargs='+', help='.stats.json files written by the jobs')
+    parser.add_argument('-o', '--output', help='write the summary to this .json file')
+    args = parser.parse_args()
+
+    reports = []
+    for fname in args.reports:
+        try:
+            reports.append(load_report(fname))
+        except (OSError, ValueError) as e:
+            print('Skipping', fname, ':', e)
+    if not reports:
+        sys.exit('No job reports found')
+    summary = summarize(reports)
+    print_summary(summary)
+    if args.output:
+        save_summary(args.output, summary)
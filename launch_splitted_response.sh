@@ -108,6 +108,8 @@ echo "Setting up production directory at ${SCRIPT_FOLDER}"
 setup_prod_dir
 check_errors
 
+RUN_ID=$(python3 -c "import uuid; print(uuid.uuid1())")
+echo "Run id: ${RUN_ID}"
 touch $SCRIPT_FOLDER/config.txt
 > $SCRIPT_FOLDER/config.txt
 echo "${RESPONSE_CONFIG}" >> "$SCRIPT_FOLDER/config.txt"                        #configfile
@@ -117,8 +119,8 @@ echo "False" >> "$SCRIPT_FOLDER/config.txt"                            #no-cut o
 echo "1" >> "$SCRIPT_FOLDER/config.txt"                        #jobNumber
 echo "${JOB_SIZE}" >> "$SCRIPT_FOLDER/config.txt"                        #jobSize
 echo "${STARTING_EVENT}" >> "$SCRIPT_FOLDER/config.txt"                     #start from event n
-echo "False" >> "$SCRIPT_FOLDER/config.txt"                            #idrun
-echo "" >> "$SCRIPT_FOLDER/config.txt"
+echo "True" >> "$SCRIPT_FOLDER/config.txt"                             #idrun
+echo "${RUN_ID}" >> "$SCRIPT_FOLDER/config.txt"                        #same run id (and random numbers) for all the jobs
 
 ID=0
 while [ $ID -lt $JOBNUMBER ]
@@ -170,16 +172,25 @@ JOB_ID=$(echo ${JOB_ID} | sed "s/\.//g")
 #echo "$JOB_ID" > "$LOGS_FOLDER/tmp_log"
 #JOB_ID=$(head -n 1 $LOGS_FOLDER/tmp_log)
 echo ${JOB_ID}
+
+#merge response.drdf files as soon as each job writes its own
+echo "Merging drdf files while the jobs run (log in $LOGS_FOLDER/merge.log)"
+rm -f ${SCRIPT_FOLDER}/jobs_done
+python3 ${SCRIPT_PATH}/merge.py ${OUTPUT_FOLDER} --follow ${JOBNUMBER} --stop-file ${SCRIPT_FOLDER}/jobs_done > $LOGS_FOLDER/merge.log 2>&1 &
+MERGE_PID=$!
+trap "kill ${MERGE_PID} 2>/dev/null" EXIT        #an interrupted merge is resumed by running the same command again
+
 check_condor ${JOB_ID} ${JOBNUMBER}
 echo "Job completed"
+touch ${SCRIPT_FOLDER}/jobs_done
 
 end=`date +%s`
 echo "Execution time for splitted_fast_resp was `expr $end - $start` seconds." >> $LOGS_FOLDER/time.log
 
-#merge response.drdf files
-FILENUMBER=$((${EVENT_NUMBER} / ${JOB_SIZE} ))
-echo "Merging drdf files"
-python3 ${SCRIPT_PATH}/merge.py ${OUTPUT_FOLDER} ${FILENUMBER}
+#time spent in each stage, photons and peak memory of the jobs, to choose jobSize and request_memory
+python3 ${SCRIPT_PATH}/jobstats.py ${OUTPUT_FOLDER}/response_*.stats.json -o ${LOGS_FOLDER}/stats.json >> $LOGS_FOLDER/time.log
+
+wait ${MERGE_PID}
 check_errors
 echo "Merge completed"
 
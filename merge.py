@@ -1,25 +1,156 @@
 import drdf
 import uuid
 import sys
-import numpy as np
-
-drdf_path = sys.argv[1]
-evn_num = sys.argv[2]
-
-# create new drdf
-mergefile = drdf.DRDF()
-mergefile.start_run(uuid.uuid1())
-mergefile.set_georef("DUMMY")
-
-# ---- sort files in numerical order and merge them ---- 
-for index in range(int(evn_num)):
-    path=drdf_path+'/response_'+str(index)+'.drdf'
-    testfile = drdf.DRDF()
-    testfile.read(path)
-    for run, rundata in testfile.runs.items():
-      for event, eventdata in rundata.items():
-        mergefile.start_event(event)
-        for src, image in eventdata.items():
-          mergefile.add_image(src, image)           #add images to new drdf
-          
-mergefile.write(drdf_path+'/response.drdf')  
+import os
+import re
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+def shard_path(drdf_path, index):
+    return os.path.join(drdf_path, 'response_'+str(index)+'.drdf')
+
+def find_shards(drdf_path):
+    '''response_N.drdf files in drdf_path, in numerical order of N'''
+    shards = []
+    for path in glob.glob(os.path.join(drdf_path, 'response_*.drdf')):
+      match = re.fullmatch(r'response_(\d+)\.drdf', os.path.basename(path))
+      if match:
+        shards.append((int(match.group(1)), path))
+    return [path for index, path in sorted(shards)]
+
+def open_shard(path, verify=True):
+    '''map the shard and verify its checksum, without decoding any image'''
+    return drdf.DRDFReader(path, verify=verify, index=False)
+
+def try_open_shard(path):
+    '''the shard if it is complete and valid, None if it is missing or still being written'''
+    try:
+      return open_shard(path)
+    except (OSError, ValueError):
+      return None
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+def append_shard(mergefile, reader, nevents):
+    '''copy the event chunks of reader at the end of mergefile, all in one run'''
+    for run, rundata in reader.runs.items():
+      if nevents == 0 and len(rundata) > 0:
+        mergefile.start_run(run)                          #all the jobs of a production share the run id
+        mergefile.set_georef(reader.georefs.get(run, "DUMMY"))
+      for event in rundata:
+        mergefile.copy_event(reader, event, run)
+        nevents += 1
+    reader.close()
+    return nevents
+
+def finish(mergefile, nevents, partial, output):
+    '''complete the partial file and move it, with its index, to output'''
+    if nevents == 0:
+      mergefile.start_run(uuid.uuid1())
+      mergefile.set_georef("DUMMY")
+    mergefile.close()
+    os.replace(partial, output)
+    if mergefile.index:
+      os.replace(partial + '.idx', output + '.idx')
+    else:
+      with drdf.DRDFReader(output, verify=False, index=False) as reader:     #resumed merge, index from the chunk headers
+        drdf.write_index(output, reader)
+
+def remove_partial(partial):
+    for f in (partial, partial + '.idx', partial + '.json'):
+      if os.path.exists(f):
+        os.remove(f)
+
+def merge(shards, output):
+    '''merge all the shards at once, the next one is read while the current one is copied'''
+    nevents = 0
+    partial = output + '.part'                                #a failed merge must not leave a valid looking response.drdf
+    mergefile = drdf.DRDFWriter(partial, index=True)
+    try:
+      with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = pool.submit(open_shard, shards[0])
+        for i in range(len(shards)):
+          reader = pending.result()
+          if i + 1 < len(shards):
+            pending = pool.submit(open_shard, shards[i+1])
+          nevents = append_shard(mergefile, reader, nevents)
+      finish(mergefile, nevents, partial, output)
+    except BaseException:
+      mergefile.close()
+      remove_partial(partial)
+      raise
+    return nevents
+
+def save_state(fname, state):
+    with open(fname + '.tmp', 'w') as f:
+      json.dump(state, f)
+    os.replace(fname + '.tmp', fname)
+
+def merge_incremental(drdf_path, nshards, output, stop_file=None, poll=5):
+    '''append response_0 ... response_<nshards-1> to output in order, each as soon as it is complete.
+       The state is saved after every file, so an interrupted merge restarts where it stopped.'''
+    partial = output + '.part'
+    checkpoint = partial + '.json'
+    if os.path.exists(checkpoint) and os.path.exists(partial):
+      with open(checkpoint) as f:
+        state = json.load(f)
+      mergefile = drdf.DRDFWriter(partial, resume=(state['pos'], state['crc']))
+      print('Resuming merge after', state['shards'], 'files')
+    else:
+      state = {'shards': 0, 'events': 0}
+      mergefile = drdf.DRDFWriter(partial, index=True)
+    ready = {}                                                #shards completed out of order, number -> signature of the validated file
+    while state['shards'] < nshards:
+      stopping = stop_file is not None and os.path.exists(stop_file)
+      path = shard_path(drdf_path, state['shards'])
+      if state['shards'] in ready and os.path.exists(path) and ready[state['shards']] == file_signature(path):
+        reader = open_shard(path, verify=False)
+      else:
+        reader = try_open_shard(path)
+      if reader is not None:
+        ready.pop(state['shards'], None)
+        state['events'] = append_shard(mergefile, reader, state['events'])
+        state['shards'] += 1
+        state['pos'], state['crc'] = mergefile.checkpoint()
+        save_state(checkpoint, state)
+        print('Merged', path)
+        continue
+      for i in range(state['shards'] + 1, nshards):
+        if i not in ready:
+          reader = try_open_shard(shard_path(drdf_path, i))
+          if reader is not None:
+            ready[i] = file_signature(shard_path(drdf_path, i))
+            reader.close()
+      if stopping:
+        mergefile.file.close()
+        missing = [i for i in range(state['shards'], nshards) if i not in ready]
+        raise IOError('Missing or invalid files: ' + ', '.join(shard_path(drdf_path, i) for i in missing))
+      time.sleep(poll)
+    finish(mergefile, state['events'], partial, output)
+    os.remove(checkpoint)
+    return state['events']
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the response_N.drdf files of a production')
+    parser.add_argument('drdf_path', help='folder containing the response_N.drdf files')
+    parser.add_argument('-o', '--output', help='merged file (default: <drdf_path>/response.drdf)')
+    parser.add_argument('-f', '--follow', type=int, metavar='N', help='merge response_0 ... response_<N-1> incrementally, as the jobs produce them')
+    parser.add_argument('--stop-file', help='in follow mode, give up waiting for missing files once this file exists')
+    parser.add_argument('--poll', type=float, default=5, help='seconds between checks in follow mode (default: 5)')
+    args = parser.parse_args()
+
+    output = args.output or os.path.join(args.drdf_path, 'response.drdf')
+    if args.follow is not None:
+      nevents = merge_incremental(args.drdf_path, args.follow, output, args.stop_file, args.poll)
+      print('Merged', nevents, 'events from', args.follow, 'files into', output)
+    else:
+      shards = find_shards(args.drdf_path)
+      if not shards:
+        sys.exit('No response_N.drdf files found in ' + args.drdf_path)
+      nevents = merge(shards, output)
+      print('Merged', nevents, 'events from', len(shards), 'files into', output)
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import glob
+import time
+import json
+import uuid
+import shutil
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import merge
+import jobstats
+import sharding
+import workqueue
+
+SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
+SCHEDD = 'sn-02.cr.cnaf.infn.it'
+ENVIRONMENT = ['source /opt/exp_software/neutrino/env.sh',
+               'source /opt/exp_software/neutrino/ROOT/v6.20.00_py3/bin/thisroot.sh',
+               'LD_LIBRARY_PATH=/opt/exp_software/neutrino/PYTHON3_PACKAGES/:/opt/exp_software/neutrino/ROOT/v6.20.00_py3/lib:$LD_LIBRARY_PATH',
+               'PATH=/opt/exp_software/neutrino/PYTHON3_PACKAGES/:/opt/exp_software/neutrino/ROOT/v6.20.00_py3/bin:/usr/local/bin:/usr/bin:/usr/local/sbin:/usr/sbin:$PATH',
+               'MANPATH=/opt/exp_software/neutrino/ROOT/v6.20.00_py3/man:$MANPATH:']
+KEYS = {'inputFile': 'input', 'ProductionFolder': 'prod_path', 'ProductionPath': 'prod_path', 'eventNumber': 'events', 'jobSize': 'job_size',
+        'startingEvent': 'start', 'responseConfig': 'response_config', 'edepFile': 'edep_file',
+        'FastAnalysis': 'fast_analysis', 'PlotCameras': 'plot_cameras'}
+
+def load_production(config):
+    """production configuration file (key = value lines, as read by load_config.sh) and the folders of the production"""
+    values = {}
+    with open(config) as f:
+        for line in f:
+            key, sep, value = line.partition('=')
+            if sep:
+                values.setdefault(key.strip(), value.strip())          #the first occurrence wins, as in load_config.sh
+    prod = {'fast_analysis': 'no', 'plot_cameras': 'no', 'edep_file': ''}
+    prod.update((name, values[key]) for key, name in KEYS.items() if key in values)
+    missing = [' or '.join(key for key in KEYS if KEYS[key] == name) for name in dict.fromkeys(KEYS.values()) if name not in prod]
+    if missing:
+        raise ValueError('missing in ' + config + ': ' + ', '.join(missing))
+    for name in ('events', 'job_size', 'start'):
+        prod[name] = int(prod[name])
+    relpath = os.path.relpath(os.path.dirname(os.path.realpath(config)), os.path.join(SCRIPT_PATH, 'configs'))
+    prod['script_folder'] = os.path.join(prod['prod_path'], relpath)
+    prod['output_folder'] = os.path.join(prod['script_folder'], 'output')
+    prod['logs_folder'] = os.path.join(prod['script_folder'], 'log')
+    prod['njobs'] = (prod['events'] + prod['job_size'] - 1) // prod['job_size']
+    return prod
+
+def setup_prod_dir(prod):
+    for folder in ('script_folder', 'logs_folder', 'output_folder'):
+        os.makedirs(prod[folder], exist_ok=True)
+    for sub in ('log', 'err'):
+        os.makedirs(os.path.join(prod['logs_folder'], sub), exist_ok=True)
+    os.makedirs(os.path.join(prod['script_folder'], 'many_configs'), exist_ok=True)
+
+def job_config(prod, job):
+    return os.path.join(prod['script_folder'], 'many_configs', 'config_' + str(job) + '.txt')
+
+def write_job_configs(prod, run_id):
+    """input of splitted_fast_resp.py for each job"""
+    for job in range(prod['njobs']):
+        lines = [prod['response_config'], prod['input'], merge.shard_path(prod['output_folder'], job), 'False',
+                 str(job), str(prod['job_size']), str(prod['start']), 'True', str(run_id)]      #same run id (and random numbers) for all the jobs
+        if 'shards' in prod:
+            shard = prod['shards'][job]
+        else:                                #the last job stops at the end of the production, not after jobSize events
+            first = prod['start'] + job * prod['job_size']
+            shard = (first, min(first + prod['job_size'], prod['start'] + prod['events']))
+        lines.append(sharding.format_events([shard]))
+        with open(job_config(prod, job), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+IDLE, RUNNING, DONE, FAILED = 'idle', 'running', 'done', 'failed'
+
+class LocalBackend:
+    """runs the jobs on this machine, with at most processes jobs at the same time"""
+
+    def __init__(self, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+
+    def submit(self, prod, jobs):
+        self.states = {job: IDLE for job in jobs}
+        self.pool = ThreadPoolExecutor(max_workers=self.processes)           #each thread waits for its job process
+        for job in jobs:
+            self.pool.submit(self._run, prod, job)
+
+    def _run(self, prod, job):
+        self.states[job] = RUNNING
+        with open(os.path.join(prod['logs_folder'], 'log', 'job_' + str(job) + '.log'), 'w') as out, \
+             open(os.path.join(prod['logs_folder'], 'err', 'job_' + str(job) + '.err'), 'w') as err:
+            code = subprocess.call([sys.executable, os.path.join(SCRIPT_PATH, 'splitted_fast_resp.py'), job_config(prod, job)] + prod.get('worker_args', []),
+                                   stdout=out, stderr=err)
+        self.states[job] = DONE if code == 0 else FAILED
+
+    def status(self):
+        return dict(self.states)
+
+    def finish(self):
+        self.pool.shutdown()
+
+    def remove(self, jobs):
+        pass                                               #failed local jobs have already exited
+
+class CondorBackend:
+    """submits the jobs to HTCondor as one cluster and queries the state of all of them in one call"""
+
+    def __init__(self, schedd=SCHEDD, request_memory=8192):
+        self.schedd = schedd
+        self.request_memory = request_memory
+
+    def _condor(self, command, *args):
+        return subprocess.run([command] + (['-name', self.schedd] if self.schedd else []) + list(args),
+                              check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+    def submit(self, prod, jobs):
+        script = os.path.join(prod['script_folder'], 'splitted_fast_resp.sh')
+        with open(script, 'w') as f:
+            f.write('\n'.join(['#!/bin/bash', '#file name: splitted_fast_resp.sh'] + ENVIRONMENT +
+                              ['python3 ' + os.path.join(SCRIPT_PATH, 'splitted_fast_resp.py') + ' "$@"']) + '\n')
+        os.chmod(script, 0o755)
+        logs = prod['logs_folder']
+        submit = os.path.join(prod['script_folder'], 'splitted_fast_resp.sub')
+        with open(submit, 'w') as f:
+            f.write('environment             = "PYTHONPATH=/opt/exp_software/neutrino/PYTHON3_PACKAGES"\n'
+                    'request_memory = %d\n' % self.request_memory +
+                    'executable              = %s\n' % script +
+                    'arguments               = %s\n' % ' '.join([os.path.join(prod['script_folder'], 'many_configs', 'config_$(Job).txt')] + prod.get('worker_args', [])) +
+                    'log                     = %s\n' % os.path.join(logs, 'log', 'job_$(Job).log') +
+                    'output                  = %s\n' % os.path.join(logs, 'log', 'job_$(Job).out') +
+                    'error                   = %s\n' % os.path.join(logs, 'err', 'job_$(Job).err') +
+                    'queue Job in (%s)\n' % ' '.join(map(str, jobs)))
+        out = self._condor('condor_submit', '-spool', submit)
+        with open(os.path.join(logs, 'tmp_log'), 'w') as f:
+            f.write(out)
+        self.cluster = out.split('cluster ')[1].split('.')[0].strip()
+        self.jobs = list(jobs)                             #process N of the cluster runs jobs[N]
+        print('Submitted cluster', self.cluster)
+
+    def status(self):
+        """JobStatus and ExitCode of all the processes: condor_q, and condor_history for those which left the queue"""
+        states = {}
+        self._parse(self._condor('condor_q', self.cluster, '-af', 'ProcId', 'JobStatus', 'ExitCode'), states)
+        if len(states) < len(self.jobs):
+            self._parse(self._condor('condor_history', self.cluster, '-af', 'ProcId', 'JobStatus', 'ExitCode'), states)
+        return {job: states.get(proc, IDLE) for proc, job in enumerate(self.jobs)}
+
+    def _parse(self, out, states):
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) < 2 or int(fields[0]) in states:
+                continue
+            proc, status = int(fields[0]), fields[1]
+            if status == '4':
+                states[proc] = DONE if len(fields) < 3 or fields[2] in ('0', 'undefined') else FAILED
+            else:
+                states[proc] = {'1': IDLE, '2': RUNNING}.get(status, FAILED)     #held (5) or removed (3)
+
+    def finish(self):
+        self._condor('condor_transfer_data', self.cluster)
+
+    def remove(self, jobs):
+        """held jobs must leave the queue before they are submitted again"""
+        self._condor('condor_rm', *['%s.%d' % (self.cluster, self.jobs.index(job)) for job in jobs])
+
+BACKENDS = {'local': LocalBackend, 'condor': CondorBackend}
+
+def wait_jobs(backend, poll=15):
+    """polls the backend until every job is done or failed; returns the final states"""
+    last = None
+    while True:
+        states = backend.status()
+        counts = {state: sum(1 for s in states.values() if s == state) for state in (RUNNING, IDLE, DONE, FAILED)}
+        if counts != last:
+            print('Running %d, idle %d, completed %d, failed %d.' % (counts[RUNNING], counts[IDLE], counts[DONE], counts[FAILED]))
+            last = counts
+        if counts[RUNNING] == counts[IDLE] == 0:
+            return states
+        time.sleep(poll)
+
+def balance_shards(prod, nshards):
+    """nshards (or fewer) event ranges with about the same photons, from a pre-scan of the input file"""
+    counts, cameras = sharding.photon_index(prod['input'], prod['start'], prod['start'] + prod['events'],
+                                            os.path.join(prod['script_folder'], 'photon_index.npz'))
+    shards = sharding.balanced_shards(counts.sum(axis=1) + sharding.EVENT_WORK, nshards, prod['start'])
+    if not shards:
+        sys.exit('No events to balance in ' + prod['input'])
+    photons = sharding.shard_work(counts, shards, prod['start'])
+    print('Balanced', len(shards), 'shards: %d to %d events, largest shard %.2f times the mean photons' % (
+          min(last - first for first, last in shards), max(last - first for first, last in shards),
+          max(photons) / max(sum(photons) / len(photons), 1)))
+    return shards
+
+def prepare_jobs(prod, balance=False, queue_block=None):
+    """job configs, work queue and run id of a new production, saved in production.json; returns the number of files to merge"""
+    stop = prod['start'] + prod['events']
+    if queue_block:
+        nblocks = (prod['events'] + queue_block - 1) // queue_block
+        if balance:
+            blocks = [[shard] for shard in balance_shards(prod, nblocks)]
+        else:
+            blocks = [[(first, min(first + queue_block, stop))] for first in range(prod['start'], stop, queue_block)]
+        queue = os.path.join(prod['script_folder'], 'queue')
+        shutil.rmtree(queue, ignore_errors=True)                 #queue of a previous production
+        workqueue.create(queue, blocks)
+        prod['worker_args'] = ['--queue', queue]
+        nshards = len(blocks)
+        print('Work queue of', nshards, 'blocks in', queue)
+    else:
+        if balance:
+            prod['shards'] = balance_shards(prod, prod['njobs'])
+            prod['njobs'] = len(prod['shards'])
+        nshards = prod['njobs']
+    run_id = uuid.uuid1()
+    print('Run id:', run_id)
+    write_job_configs(prod, run_id)
+    for f in merge.find_shards(prod['output_folder']) + glob.glob(os.path.join(prod['output_folder'], '*.stats.json')) + \
+             glob.glob(os.path.join(prod['output_folder'], '*.tmp')) + glob.glob(os.path.join(prod['output_folder'], 'response_*.drdf.part*')):
+        os.remove(f)                                       #files of a previous production must not be merged
+    merge.remove_partial(os.path.join(prod['output_folder'], 'response.drdf.part'))
+    with open(os.path.join(prod['script_folder'], 'production.json'), 'w') as f:
+        json.dump({'run_id': str(run_id), 'njobs': prod['njobs'], 'nshards': nshards, 'worker_args': prod.get('worker_args', [])}, f)
+    return nshards
+
+def unfinished_jobs(prod, saved):
+    """jobs of an interrupted production still to run: those without their output file, or all the workers of an unfinished queue"""
+    if saved['worker_args']:
+        queue = workqueue.status(saved['worker_args'][1])
+        return list(range(saved['njobs'])) if queue['done'] < queue['blocks'] else []
+    return [job for job in range(saved['njobs']) if not os.path.exists(merge.shard_path(prod['output_folder'], job))]
+
+def run_jobs(prod, backend, jobs, poll=15, retries=0):
+    """submits the jobs and waits for them; the failed (or held) ones are submitted again up to retries times,
+       continuing from their last checkpoint. Returns the final states."""
+    states = {}
+    for attempt in range(retries + 1):
+        if not jobs:
+            return states
+        backend.submit(prod, jobs)
+        states.update(wait_jobs(backend, poll))
+        backend.finish()
+        jobs = sorted(job for job in jobs if states[job] == FAILED)
+        if jobs and attempt < retries:
+            backend.remove(jobs)
+            print('Resubmitting', len(jobs), 'failed jobs:', ', '.join(map(str, jobs)))
+    return states
+
+def run_production(config, backend, poll=15, balance=False, queue_block=None, retries=0, resume=False):
+    """runs the jobs of a production, merging their files while they run, then the analysis; returns the failed jobs.
+       With queue_block, the jobs are workers taking blocks of queue_block events from a work queue.
+       With resume, only the unfinished jobs of the last production with this config run again."""
+    prod = load_production(config)
+    print('Running splitted_fast_resp over', prod['events'], 'events, splitted in', prod['njobs'], 'jobs of size', prod['job_size'])
+    setup_prod_dir(prod)
+    if resume:
+        with open(os.path.join(prod['script_folder'], 'production.json')) as f:
+            saved = json.load(f)
+        prod['njobs'], nshards, prod['worker_args'] = saved['njobs'], saved['nshards'], saved['worker_args']
+        jobs = unfinished_jobs(prod, saved)
+        print('Resuming run', saved['run_id'] + ':', len(jobs), 'of', prod['njobs'], 'jobs to run')
+    else:
+        nshards = prepare_jobs(prod, balance, queue_block)
+        jobs = list(range(prod['njobs']))
+
+    start = time.time()
+    stop_file = os.path.join(prod['script_folder'], 'jobs_done')
+    output = os.path.join(prod['output_folder'], 'response.drdf')
+    if os.path.exists(stop_file):
+        os.remove(stop_file)
+    merged = {}
+    def follow():                                          #merge the files as soon as each job writes its own
+        try:
+            merged['events'] = merge.merge_incremental(prod['output_folder'], nshards, output, stop_file, poll=min(poll, 5))
+        except Exception as e:
+            merged['error'] = e
+    merger = threading.Thread(target=follow)
+    merger.start()
+    try:
+        states = run_jobs(prod, backend, jobs, poll, retries)
+    finally:
+        open(stop_file, 'w').close()
+        merger.join()
+    with open(os.path.join(prod['logs_folder'], 'time.log'), 'a') as f:
+        f.write('Execution time for splitted_fast_resp was %d seconds.\n' % (time.time() - start))
+    reports = [jobstats.load_report(fname) for fname in sorted(glob.glob(os.path.join(prod['output_folder'], '*.stats.json')))]
+    if reports:                                            #to choose jobSize and request_memory
+        summary = jobstats.summarize(reports)
+        jobstats.print_summary(summary)
+        jobstats.save_summary(os.path.join(prod['logs_folder'], 'stats.json'), summary)
+
+    failed = sorted(job for job, state in states.items() if state == FAILED)
+    if failed:
+        print('Failed jobs:', ', '.join(map(str, failed)), '(logs in ' + os.path.join(prod['logs_folder'], 'err') + ')')
+    if 'error' in merged:
+        print('Merge stopped:', merged['error'])
+        return failed or ['merge']
+    print('Merged', merged['events'], 'events')
+
+    if prod['fast_analysis'].lower() == 'yes':
+        analysis = os.path.join(prod['script_folder'], 'output_analysis')
+        os.makedirs(analysis, exist_ok=True)
+        print('Running fast_analysis.py in', analysis)
+        subprocess.run([sys.executable, os.path.join(SCRIPT_PATH, 'fast_analysis.py'), output, prod['edep_file'], analysis, str(prod['events']), str(prod['start']), prod['plot_cameras']], check=True)
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a production: the response jobs, the merge of their files and the analysis')
+    parser.add_argument('-c', '--config', required=True, help='production configuration file (as for launch_splitted_response.sh)')
+    parser.add_argument('-b', '--backend', choices=sorted(BACKENDS), default='condor', help='where the jobs run (default: condor)')
+    parser.add_argument('-j', '--processes', type=int, help='local backend: jobs running at the same time (default: one per cpu)')
+    parser.add_argument('--schedd', default=SCHEDD, help='condor backend: schedd to submit to (default: %(default)s, empty for the local one)')
+    parser.add_argument('--request-memory', type=int, default=8192, help='condor backend: MB of memory requested by each job (default: 8192)')
+    parser.add_argument('--balance', action='store_true', help='give the jobs about the same photons instead of the same events (pre-scan of the input file)')
+    parser.add_argument('--queue', type=int, metavar='EVENTS', help='run the jobs as workers of a work queue of blocks of EVENTS events, taken as each worker is free')
+    parser.add_argument('--retries', type=int, default=1, help='times failed or held jobs are submitted again, continuing from their checkpoints (default: 1)')
+    parser.add_argument('--resume', action='store_true', help='run only the unfinished jobs of the last production with this config, and complete its merge')
+    parser.add_argument('--poll', type=float, default=15, help='seconds between status checks (default: 15)')
+    args = parser.parse_args()
+
+    if args.backend == 'local':
+        backend = LocalBackend(args.processes)
+    else:
+        backend = CondorBackend(args.schedd or None, args.request_memory)
+    try:
+        failed = run_production(args.config, backend, args.poll, args.balance, args.queue, args.retries, args.resume)
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        sys.exit('ERROR. ' + str(e))
+    if failed:
+        sys.exit(2)
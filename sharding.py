@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import argparse
+import numpy as np
+try:
+    import ROOT
+except ImportError:                          #only needed by the pre-scan of sensors.root
+    ROOT = None
+
+EVENT_WORK = 1000                            #work of an event without photons (reading, writing its images), in photons
+
+def parse_events(spec):
+    """event ranges [first, last) from a list like '0:120,130:200,250' (a single number is one event)"""
+    ranges = []
+    for item in spec.split(','):
+        first, sep, last = item.strip().partition(':')
+        ranges.append((int(first), int(last) if sep else int(first) + 1))
+    return ranges
+
+def format_events(ranges):
+    return ','.join('%d:%d' % (first, last) for first, last in ranges)
+
+def scan_photons(rootfile, start=0, stop=None):
+    """photons of each camera in the events [start, stop) of sensors.root, from the sizes of the time vectors;
+       returns an (events, cameras) array and the camera names.
+       Only the time branch is read, but in full (decompressed): a pass done once per input file, hence photon_index"""
+    inFile = ROOT.TFile.Open(rootfile, "READ")
+    klist = inFile.GetListOfKeys()
+    cameras = [key.GetName() for key in klist if key.GetName() != 'commit_hash']
+    nEvents = inFile.Get(klist.Last().GetName()).GetEntries()
+    stop = nEvents if stop is None else min(stop, nEvents)
+    counts = np.empty((stop - start, len(cameras)), dtype=np.int64)
+    for j, name in enumerate(cameras):
+        df = ROOT.RDataFrame(name, inFile).Range(start, stop)
+        counts[:, j] = df.Define('nphotons', 'time.size()').AsNumpy(['nphotons'])['nphotons']
+    inFile.Close()
+    return counts, cameras
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def photon_index(rootfile, start, stop, fname):
+    """scan_photons of [start, stop), saved to fname (.npz) and reused as long as the input file and the range are the same"""
+    if not os.path.isfile(rootfile):                      #remote file (xrootd): no signature, scanned every time
+        return scan_photons(rootfile, start, stop)
+    if os.path.exists(fname):
+        with np.load(fname) as index:
+            if list(index['signature']) == file_signature(rootfile) and index['start'] == start and stop in (None, index['stop']):
+                return index['counts'], list(index['cameras'])
+    counts, cameras = scan_photons(rootfile, start, stop)
+    np.savez(fname + '.tmp.npz', counts=counts, cameras=np.array(cameras), start=start, stop=start + len(counts),
+             signature=np.array(file_signature(rootfile)))
+    os.replace(fname + '.tmp.npz', fname)
+    return counts, cameras
+
+def balanced_shards(work, njobs, start=0):
+    """cuts the events start ... start+len(work)-1 into consecutive ranges [first, last) with about the same total work.
+       An event is never split, so there are fewer than njobs ranges when a few events dominate; none without events."""
+    if len(work) == 0:
+        return []
+    cumulative = np.cumsum(work, dtype=np.float64)
+    middle = cumulative - np.asarray(work) / 2               #an event goes to the shard where most of its work falls
+    bounds = np.searchsorted(middle, cumulative[-1] * np.arange(1, njobs) / njobs)
+    bounds = np.unique(np.concatenate(([0], bounds, [len(work)])))
+    return [(start + int(first), start + int(last)) for first, last in zip(bounds[:-1], bounds[1:])]
+
+def shard_work(counts, shards, start=0):
+    """photons of each shard"""
+    photons = counts.sum(axis=1)
+    return [int(photons[first - start:last - start].sum()) for first, last in shards]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-scan of the photons of sensors.root and shards with the same photon work')
+    parser.add_argument('rootfile', help='sensors.root')
+    parser.add_argument('-n', '--jobs', type=int, required=True, help='number of shards')
+    parser.add_argument('-s', '--start', type=int, default=0, help='first event (default: 0)')
+    parser.add_argument('-e', '--events', type=int, help='number of events (default: up to the end of the file)')
+    parser.add_argument('-i', '--index', help='photon index .npz file, reused if it exists (default: not saved)')
+    args = parser.parse_args()
+
+    if ROOT is None:
+        sys.exit('ROOT is needed to read ' + args.rootfile)
+    stop = None if args.events is None else args.start + args.events
+    if args.index:
+        counts, cameras = photon_index(args.rootfile, args.start, stop, args.index)
+    else:
+        counts, cameras = scan_photons(args.rootfile, args.start, stop)
+    shards = balanced_shards(counts.sum(axis=1) + EVENT_WORK, args.jobs, args.start)
+    if not shards:
+        sys.exit('No events to split in ' + args.rootfile)
+    photons = shard_work(counts, shards, args.start)
+    for (first, last), n in zip(shards, photons):
+        print('%d:%d\t%d events\t%d photons' % (first, last, last - first, n))
+    print('Largest shard: %.2f times the mean' % (max(photons) / (sum(photons) / len(photons))))
@@ -10,8 +10,14 @@ import sys
 import uuid
 import xml.etree.ElementTree as ET
 import drdf
+import jobstats
+import sharding
+import workqueue
+import merge
 import time
+import json
 import argparse
+import hashlib
 
 def import_configuration(configfile):
     """reads configuration parameters from xml file and returns a dictionary"""
@@ -24,118 +30,271 @@ def import_configuration(configfile):
         configdict[name] = value
     return configdict
 
-def load_sensor_data(inFile, treekey, evn):  #arguments are: filename, camera, event
-    treename = treekey.GetName()
-    tree = inFile.Get(treename)             #select camera
-    tree.GetEntry(evn)                      #select event
-    en = np.array(tree.energy)
-    t = np.array(tree.time)
-    x = np.array(tree.x)
-    y = np.array(tree.y)
-    z = np.array(tree.z)
-    sensor_data = np.vstack((en,t,x,y,z)).T
-    return sensor_data, treename            #output: information on photons + camera name
-
-def assign_channel(photons, geom):          #arguments: sensor_data, CONFIG     
+SENSOR_BRANCHES = ['time', 'x', 'y', 'z']     #photon energy is not needed by the response
+READ_BLOCK = 64                               #events read at once from each camera tree
+CHECKPOINT = 300                              #seconds between checkpoints of the output file
+
+def read_sensor_block(inFile, treename, start, stop):  #arguments are: file, camera, event range
+    """reads the photons of events [start, stop) of a camera tree into flat columns plus per-event offsets"""
+    data = ROOT.RDataFrame(treename, inFile).Range(start, stop).AsNumpy(SENSOR_BRANCHES)
+    sizes = np.fromiter((len(v) for v in data['time']), dtype=np.int64, count=stop - start)
+    offsets = np.zeros(stop - start + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])                   #photons of event start+i are offsets[i]:offsets[i+1]
+    columns = np.empty((len(SENSOR_BRANCHES), offsets[-1]))       #one contiguous row per quantity
+    if offsets[-1]:
+        for row, branch in zip(columns, SENSOR_BRANCHES):
+            np.concatenate(data[branch], out=row)
+    return columns, offsets
+
+@jobstats.timed('read_root')
+def load_block(inFile, klist, start, stop):  #arguments are: file, list of keys, event range
+    """reads events [start, stop) of every camera, opening each tree once"""
+    cameras = [key.GetName() for key in klist if key.GetName() != 'commit_hash']
+    idEvent = ROOT.RDataFrame(klist.Last().GetName(), inFile).Range(start, stop).AsNumpy(['idEvent'])['idEvent']
+    return {'start': start, 'stop': stop, 'idEvent': idEvent,
+            'cameras': {name: read_sensor_block(inFile, name, start, stop) for name in cameras}}
+
+@jobstats.timed('load_sensor_data')
+def load_sensor_data(block, camera, evn):  #arguments are: block of events, camera, event
+    columns, offsets = block['cameras'][camera]
+    i = evn - block['start']
+    sensor_data = columns[:, offsets[i]:offsets[i + 1]].T      #view, no copy: one row per photon with time, x, y, z
+    return sensor_data, camera            #output: information on photons + camera name
+
+def load_event_data(block, evns):  #arguments are: block of events, list of events
+    """loads the photons of all cameras for the events in evns, with a camera index column"""
+    columns = []
+    cams = []
+    cameras = list(block['cameras'])
+    for i, evn in enumerate(evns):
+        for j, camera in enumerate(cameras):
+            sensor_data, sensor_name = load_sensor_data(block, camera, evn)
+            columns.append(sensor_data.T)
+            cams.append(np.full(len(sensor_data), i * len(cameras) + j))    #camera j of the i-th event of the batch
+    photons = np.hstack(columns).T if columns else np.empty((0,4))          #one contiguous array per quantity
+    cam = np.concatenate(cams) if cams else np.empty(0, dtype=int)
+    return photons, cam, cameras            #output: photons of every camera + camera index of each photon + camera names
+
+def geometry_buffers(n, dtype='float64'):
+    """scratch arrays used by assign_channel for a camera of n photons"""
+    return {'val': np.empty(n, dtype=dtype), 'keep': np.empty(n, dtype=bool), 'cut': np.empty(n, dtype=bool)}
+
+GEOM_BUF = {}                               #reused by assign_channel across cameras and events
+
+@jobstats.timed('assign_channel')
+def assign_channel(photons, geom, dtype=None, buf=None, cam=None):          #arguments: sensor_data, CONFIG, optional float type, scratch buffers and camera index
     """assigns photon to corresponding matrix channel"""    
     shape = geom['matrix']                  #SiPM matrix is 32x32
-    nch = shape[0] * shape[1]               #number of channels 
-    xside = shape[0] * (geom['cellsize'] + 2 * geom['celledge'])/ 2         #find coordinates of matrix edge 
-    yside = shape[1] * (geom['cellsize'] + 2 * geom['celledge'])/ 2         #wrt the centre of the sensor
-    
-    # ---- verify photons hit active areas and apply cuts ----
-    z_thres = np.where(np.isclose(photons[:,4], geom['zplane']))
-    active_areaX = np.where((np.abs(photons[:,2][z_thres])>=0) & (np.abs(photons[:,2][z_thres]) <= xside))
-    cut1 = np.intersect1d(z_thres,active_areaX)
-    
-    xedge = np.remainder(np.abs(photons[:,2][cut1]),(geom['cellsize'] + geom['celledge']))        
-    x_thres = np.where((xedge >= geom['celledge']) & (xedge<=(geom['cellsize']+geom['celledge'])))
-    cut2 = np.intersect1d(cut1,x_thres) 
+    pitch = geom['cellsize'] + 2 * geom['celledge']
+    xside = shape[0] * pitch / 2            #find coordinates of matrix edge 
+    yside = shape[1] * pitch / 2            #wrt the centre of the sensor
+    period = geom['cellsize'] + geom['celledge']
+    t, x, y, z = photons[:,0], photons[:,1], photons[:,2], photons[:,3]
+    if dtype is not None:
+        t, x, y, z = (np.asarray(col, dtype=dtype) for col in (t, x, y, z))
+    n = x.size
+    if buf is None:
+        buf = {}
+    if 'val' not in buf or buf['val'].size < n or buf['val'].dtype != x.dtype:
+        buf.update(geometry_buffers(n, x.dtype))
+    val, keep, cut = buf['val'][:n], buf['keep'][:n], buf['cut'][:n]
     
-    active_areaY = np.where((np.abs(photons[:,3][cut2])>=0) & (np.abs(photons[:,3][cut2]) <= yside))   
-    cut3 = np.intersect1d(cut2,active_areaY)    
-                                                  
-    yedge = np.remainder(np.abs(photons[:,3][cut3]),(geom['cellsize'] + geom['celledge']))           
-    y_thres = np.where((yedge >= geom['celledge']) & (yedge<=(geom['cellsize']+geom['celledge'])))
-    cut4 = np.intersect1d(cut3,y_thres)
+    # ---- verify photons hit active areas and apply cuts, all in the same mask ----
+    np.subtract(z, geom['zplane'], out=val)                                     #same tolerance as np.isclose
+    np.abs(val, out=val)
+    np.less_equal(val, 1e-08 + 1e-05 * abs(geom['zplane']), out=keep)
+    for coord, side in ((x, xside), (y, yside)):
+        np.abs(coord, out=val)
+        keep &= np.less_equal(val, side, out=cut)                               #active area
+        np.remainder(val, period, out=val)
+        keep &= np.greater_equal(val, geom['celledge'], out=cut)                #cell edges
+        keep &= np.less_equal(val, geom['cellsize'] + geom['celledge'], out=cut)
     
-    cell_x = np.floor_divide(photons[:,2][cut4],(geom['cellsize'] + 2 * geom['celledge'])) + (shape[0] / 2)
-    cell_y = np.floor_divide(-photons[:,3][cut4],(geom['cellsize'] + 2 * geom['celledge'])) + (shape[1] / 2)
-    time = photons[:,1][cut4]
+    time = t[keep]
+    cell_x = np.floor_divide(x[keep], pitch) + (shape[0] / 2)
+    cell_y = np.floor_divide(-y[keep], pitch) + (shape[1] / 2)
     ch = cell_y * shape[0] + cell_x         #each channel identified by a SINGLE NUMBER from 0 to 1023
+    if cam is not None:                     #photons of several cameras: channel of camera k becomes k*1024 + ch
+        nch = shape[0] * shape[1]
+        inside = (ch >= 0) & (ch < nch)
+        time = time[inside]
+        ch = cam[keep][inside] * nch + ch[inside]
     return time, ch
-    
-def count_photons(time, ch, config ):                                            #argument: time, photons (a single array) , config
-    """considering pde only for sipm response, for debugging/fast execution""" 
-    phlist = []
-    for c in range(1024):
-        ph = np.where(ch==c)               #find all photons that reached channel "c"        
-        if (ph[0].size!=0):                 
-            tmin = np.amin(time[ph])                #arrival time of first photon
-            time_cut = np.where(time[ph]<tmin+config['integrTime'])            #find all photons of the channel which arrived within integrationTime (e.g. 500ns)
-            t_num = np.count_nonzero(time[ph]<tmin+config['integrTime'])  
-            pde_ph = np.count_nonzero(np.random.uniform(0,1,t_num) < config['pde127nm'])      #apply the pde over the time-allowed photons
-            cross_ph = np.count_nonzero(np.random.uniform(0,1,pde_ph) < config['pcross'])     #apply cross-talk over the pde-allowed photons
-            nph = pde_ph + cross_ph + sum(np.random.normal(0,config['phgain'],pde_ph+cross_ph))    #count the resulting number of photons + gain on photon amp.
-           
-            phtimes_pde = time[time_cut[0:pde_ph]]                #extract from time array arrival times of resulting number of photons 
-            phtimes_cross = time[time_cut[0:cross_ph]]            #add time of photons added with cross-talk
-            phtimes = np.concatenate((phtimes_pde,phtimes_cross))                     
-            if nph < 1:                                          #can be seen as a threshold on channel amplitude 
-                count_result = (0, np.nan)
-            else:
-                count_result = (nph, tmin)                           
-        else:
-            count_result = (0, np.nan)
-        phlist.append(count_result)     
-    return phlist
-             
-def count_photons_no_cut(time, ch, config ):                                            
+
+def group_by_channel(time, ch, config, ncam=None):                              #arguments: time, channel (arrays from assign_channel), config
+    """sorts photons by channel; returns hit channels, photons per channel, photons within integration time and first arrival"""
+    shape = config['matrix']
+    nch = shape[0] * shape[1] * (ncam or 1)
+    inside = (ch >= 0) & (ch < nch)                      #photons falling outside the matrix are not counted
+    chn = ch[inside].astype(np.intp)
+    t = time[inside]
+    order = np.argsort(chn, kind='stable')               #photons of the same channel become contiguous
+    chn = chn[order]
+    t = t[order]
+    counts = np.bincount(chn, minlength=nch)
+    hit = np.flatnonzero(counts)                         #channels reached by at least one photon
+    tmin = np.full(nch, np.nan)
+    if hit.size == 0:
+        return hit, counts, counts, tmin
+    starts = np.cumsum(counts)[hit] - counts[hit]        #index of the first photon of each hit channel
+    tmin[hit] = np.minimum.reduceat(t, starts)           #arrival time of first photon
+    in_window = t < np.repeat(tmin[hit], counts[hit]) + config['integrTime']     #photons which arrived within integrationTime (e.g. 500ns)
+    t_num = np.bincount(chn[in_window], minlength=nch)
+    return hit, counts, t_num, tmin
+
+def new_image(config, out=None, ncam=None):
+    """returns an empty (amplitude, time) image, or a stack of ncam images, filling out if given"""
+    shape = config['matrix']
+    if out is None:
+        out = np.empty(((ncam,) if ncam else ()) + (shape[0], shape[1], 2), dtype='float32')
+    out[...,0] = 0
+    out[...,1] = np.nan
+    return out
+
+def camera_rng(run_uuid, idEvent, camera):         #arguments: run UUID, event id, camera name
+    """random generator of a camera in an event: Philox keyed by the run, counter starting from (event, camera)"""
+    camhash = int.from_bytes(hashlib.blake2b(camera.encode('ascii'), digest_size=8).digest(), 'little')
+    counter = np.array([0, 0, idEvent, camhash], dtype=np.uint64)         #draws only advance the first word
+    return np.random.Generator(np.random.Philox(counter=counter, key=run_uuid.int))
+
+def sipm_response(t_num, rng, config):              #arguments: photons within integration time of each channel, generator, config
+    """amplitude of each channel; all the random numbers of a camera are drawn in three calls"""
+    if config.get('sampling', 'photon') == 'channel':
+        return sipm_response_channel(t_num, rng, config)
+    chan = np.arange(t_num.size)
+    pde_ph = np.bincount(np.repeat(chan, t_num)[rng.random(t_num.sum()) < config['pde127nm']], minlength=chan.size)      #apply the pde over the time-allowed photons
+    cross_ph = np.bincount(np.repeat(chan, pde_ph)[rng.random(pde_ph.sum()) < config['pcross']], minlength=chan.size)    #apply cross-talk over the pde-allowed photons
+    nph = pde_ph + cross_ph
+    gain = np.bincount(np.repeat(chan, nph), weights=rng.normal(0, config['phgain'], nph.sum()), minlength=chan.size)    #gain over photon amp.
+    return nph + gain
+
+def sipm_response_channel(t_num, rng, config):      #arguments: photons within integration time of each channel, generator, config
+    """same distribution as sipm_response, drawing the counts and the total gain of each channel instead of each photon"""
+    pde_ph = rng.binomial(t_num, config['pde127nm'])                 #detected photons
+    cross_ph = rng.binomial(pde_ph, config['pcross'])                #cross-talk photons
+    nph = pde_ph + cross_ph
+    gain = rng.normal(0, config['phgain'] * np.sqrt(nph))            #sum of nph gaussian smearings
+    return nph + gain
+
+@jobstats.timed('count_photons')
+def count_photons(time, ch, config, out=None, ncam=None, rngs=None):          #argument: time, photons (a single array), config
+    """considering pde only for sipm response, for debugging/fast execution"""
+    hit, counts, t_num, tmin = group_by_channel(time, ch, config, ncam)
+    img = new_image(config, out, ncam)
+    pix = img.reshape(-1, 2)                             #one (amplitude, time) row per channel
+    shape = config['matrix']
+    nch = shape[0] * shape[1]
+    if rngs is None:                                     #one generator per camera, see camera_rng
+        rngs = [np.random.default_rng()] * (ncam or 1)
+    bounds = np.searchsorted(hit, np.arange(len(rngs) + 1) * nch)      #hit channels of camera k are hit[bounds[k]:bounds[k+1]]
+    for k, rng in enumerate(rngs):
+        c = hit[bounds[k]:bounds[k + 1]]
+        if c.size == 0:
+            continue
+        nph = sipm_response(t_num[c], rng, config)
+        c = c[nph >= 1]                                  #can be seen as threshold
+        pix[c, 0] = nph[nph >= 1]
+        pix[c, 1] = tmin[c]
+    return img
+
+@jobstats.timed('count_photons_no_cut')
+def count_photons_no_cut(time, ch, config, out=None, ncam=None):
     """considers simply the total number of photons reaching each camera"""
-    phlist = []
-    for c in range(1024):
-        ph = np.where(ch==c)               #find all photons that reached channel "c"        
-        if (ph[0].size!=0):                  
-            tmin = np.amin(time[ph])            #arrival time of first photon
-            nph = time[ph].size               
-            if nph < 1:                          #can be seen as threshold on channel amplitude
-                count_result = (0, np.nan)
-            else:
-                count_result = (nph, tmin)                           
-        else:
-            count_result = (0, np.nan)
-        phlist.append(count_result)         
-    return phlist
-            
-def main_evn(inFile,klist,evn,drdffile):
-         treeEv = inFile.Get(klist.Last().GetName())     #opening tree of first sensor to get idEvent
-         treeEv.GetEntry(evn)                        #select event
-         idEvent = treeEv.idEvent                    
-         drdffile.start_event(idEvent)
-         for key in klist:                           #loop over cameras (the keys of the list)
-             if key.GetName() != 'commit_hash':
-                 sensor_data, sensor_name= load_sensor_data(inFile, key, evn)
-                 t_arr, sensor_data = assign_channel(sensor_data, CONFIG)           #output energy+time
-                 if eval(nocut):
-                     detected_ph_time = count_photons_no_cut(t_arr, sensor_data, CONFIG)  
-                     imgshape = CONFIG['matrix']
-                     img = np.asarray(detected_ph_time).reshape(imgshape[0], imgshape[1], 2).astype('float32')   #reshape the list of ph 
-                     image = drdf.Image(img)
-                     drdffile.add_image(sensor_name, image)
-                 else: 
-                     detected_ph_time = count_photons(t_arr, sensor_data, CONFIG)       #list of : nph + timeof first arrival
-                     imgshape = CONFIG['matrix']
-                     img = np.asarray(detected_ph_time).reshape(imgshape[0], imgshape[1], 2).astype('float32')   #reshape the list of ph 
-                     image = drdf.Image(img)
-                     drdffile.add_image(sensor_name, image)
+    hit, counts, t_num, tmin = group_by_channel(time, ch, config, ncam)
+    img = new_image(config, out, ncam)
+    pix = img.reshape(-1, 2)
+    pix[hit, 0] = counts[hit]
+    pix[hit, 1] = tmin[hit]                              #arrival time of first photon
+    return img
+
+def event_tensor(photons, cam, ncam, config, nocut=False, out=None, rngs=None):
+    """runs geometry and counting once over the photons of ncam cameras; returns a (ncam,32,32,2) image tensor"""
+    t_arr, ch = assign_channel(photons, config, buf=GEOM_BUF, cam=cam)
+    jobstats.count('photons', len(photons))
+    jobstats.count('photons_on_sipm', len(t_arr))
+    if nocut:
+        return count_photons_no_cut(t_arr, ch, config, out, ncam)
+    return count_photons(t_arr, ch, config, out, ncam, rngs)
 
+def main_evn(block,evn,drdffile):           #evn is a single event or a batch of events, all inside block
+         evns = np.atleast_1d(evn)
+         photons, cam, cameras = load_event_data(block, evns)
+         idEvents = [int(block['idEvent'][evn - block['start']]) for evn in evns]
+         jobstats.count('events', len(evns))
+         rngs = [camera_rng(runid, idEvent, camera) for idEvent in idEvents for camera in cameras]     #same random numbers however events are split among jobs
+         images = event_tensor(photons, cam, len(evns) * len(cameras), CONFIG, eval(nocut), rngs=rngs)      #all cameras of all events at once
+         images = images.reshape((len(evns), len(cameras)) + images.shape[1:])
+         with jobstats.timed('drdf_write'):
+             for i, idEvent in enumerate(idEvents):
+                 drdffile.start_event(idEvent)
+                 for camera, img in zip(cameras, images[i]):     #cameras without photons give an empty image
+                     image = drdf.Image(img)
+                     drdffile.add_image(camera, image)
          return drdffile        
+
+def resume_state(partial, job):
+    """progress saved by an interrupted run of the same job, None if there is none"""
+    try:
+        with open(partial + '.json') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state['job'] != job or state['run'] != str(runid) or not os.path.exists(partial) or os.path.getsize(partial) < state['pos']:
+        return None
+    return state
+
+def write_response(inFile, klist, ranges, wfile, job=None, checkpoint=None):    #arguments are: sensors.root, its keys, event ranges, output .drdf file
+    """with checkpoint (seconds), the file is written as wfile.part and its progress saved in wfile.part.json:
+       a job started again with the same config continues after the last checkpoint"""
+    partial = wfile + '.part' if checkpoint else wfile
+    state = resume_state(partial, job) if checkpoint else None
+    if state is not None:
+        drdffile = drdf.DRDFWriter(partial, resume=(state['pos'], state['crc']))
+        print('Resuming after', state['events'], 'events')
+        jobstats.count('events_resumed', state['events'])
+    else:
+        state = {'job': job, 'run': str(runid), 'events': 0}
+        drdffile = drdf.DRDFWriter(partial)               #images are written as soon as they are computed
+        drdffile.start_run(runid)
+        drdffile.set_georef("DUMMY")
+    skip = state['events']
+    saved = time.perf_counter()
+    for start, stop in ranges:
+        start, skip = min(start + skip, stop), max(skip - (stop - start), 0)       #events done before the checkpoint
+        for first in range(start, stop, READ_BLOCK):        #loop over blocks of events read together
+            last = min(first + READ_BLOCK, stop)
+            block = load_block(inFile, klist, first, last)
+            for evn in range(first, last):
+                drdffile=main_evn(block,evn,drdffile)
+                state['events'] += 1
+                if checkpoint and time.perf_counter() - saved > checkpoint:
+                    with jobstats.timed('checkpoint'):
+                        state['pos'], state['crc'] = drdffile.checkpoint(trailer=True)     #readable as it is
+                        merge.save_state(partial + '.json', state)
+                    saved = time.perf_counter()
+    with jobstats.timed('drdf_write'):
+        drdffile.close() 
+    if checkpoint:
+        os.replace(partial, wfile)                  #the output file appears only when complete
+        merge.remove_partial(partial)               #progress and index of the partial file, if it was read
+
+def check_ranges(ranges, nEvents):
+    for start, stop in ranges:
+        if ((start > nEvents) or (stop > nEvents)):         #check whether interval is allowed
+            sys.exit("ERROR. Invalid Jobnumber or Start_event")
     
 if __name__ == '__main__':
     
     start_time = time.perf_counter()
     
-    file = open(sys.argv[1],"r")
+    parser = argparse.ArgumentParser(description='Detector response of the events of a job, given by a config file')
+    parser.add_argument('config', help='job config file')
+    parser.add_argument('--queue', help='work queue folder (see workqueue.py): process its blocks until all are done, instead of the events of the config file')
+    parser.add_argument('--checkpoint', type=float, default=CHECKPOINT, help='seconds between checkpoints, from which a job started again continues (default: %(default)s, 0 for none)')
+    parser.add_argument('--timeout', type=float, default=workqueue.TIMEOUT, help='seconds without heartbeat after which the block of another worker is taken over (default: %(default)s)')
+    args = parser.parse_args()
+    
+    file = open(args.config,"r")
     content = file.read().splitlines()
     
     configfile = content[0]    #configuration .xml file
@@ -146,38 +305,50 @@ if __name__ == '__main__':
     jobSize = int(content[5])        #size of submitted job from bash script
     start_evn = int(content[6])      #staring event (if not 0)
     idrun = content[7]          #run identifier (UUID) (True or False)  ------------------>>>>> if True, read also line 8
+    events = content[9] if len(content) > 9 else ''     #optional event ranges (e.g. 0:120,130:200), replacing jobSize and start_evn
         
     CONFIG = import_configuration(configfile)               #geometrical configuration
-    drdffile = drdf.DRDF()
     if eval(idrun):              
         try: 
             runid = uuid.UUID(content[8])
         except ValueError:
             print('Insert valid run identifier (UUID format)')
             sys.exit()              
-        drdffile.start_run(runid)
     else:
         runid = uuid.uuid1()
-        drdffile.start_run(runid)
         print('run id: ', runid)
-    drdffile.set_georef("DUMMY")
         
     inFile = ROOT.TFile.Open(fname, "READ")         #file sensors.root
     klist = inFile.GetListOfKeys()
     nEvents = inFile.Get(klist.Last().GetName()).GetEntries()      
-    start = jobSize*jobNumber + start_evn           #defining event interval
-    stop = jobSize*(jobNumber+1) + start_evn   
-    if ((start > nEvents) or (stop > nEvents)):         #check whether interval is allowed
-        sys.exit("ERROR. Invalid Jobnumber or Start_event")
-
-    for evn in range(start,stop):
-        drdffile=main_evn(inFile,klist,evn,drdffile)
-    drdffile.write(wfile) 
+    if args.queue:                                  #worker: one output file per block, response_<block>.drdf in the folder of wfile
+        worker = workqueue.worker_name()
+        done = []
+        for nblock, ranges in workqueue.blocks(args.queue, worker, args.timeout):
+            check_ranges(ranges, nEvents)
+            shard = merge.shard_path(os.path.dirname(wfile), nblock)
+            write_response(inFile, klist, ranges, shard + '.' + worker + '.tmp')
+            os.replace(shard + '.' + worker + '.tmp', shard)         #a block computed twice gives the same file
+            print('Block', nblock, 'done:', sharding.format_events(ranges))
+            done.extend(ranges)
+    else:
+        if events:
+            ranges = sharding.parse_events(events)
+        else:
+            start = jobSize*jobNumber + start_evn           #defining event interval
+            stop = jobSize*(jobNumber+1) + start_evn   
+            ranges = [(start, stop)]
+        check_ranges(ranges, nEvents)
+        write_response(inFile, klist, ranges, wfile, content, args.checkpoint)
     
     #print("img file saved.")
     inFile.Close()
     end_time=time.perf_counter()
     print("--- %s seconds ---" % (end_time - start_time))
+    if args.queue:
+        jobstats.save_report(os.path.join(os.path.dirname(wfile), 'worker_' + worker + '.stats.json'), job=worker, events=sharding.format_events(done))
+    else:
+        jobstats.save_report(os.path.splitext(wfile)[0] + '.stats.json', job=jobNumber, events=sharding.format_events(ranges))     #collected by launch_splitted_response.sh
 
     #to set up environment
     #export PYTHONPATH=/opt/exp_software/neutrino/PYTHON3_PACKAGES/
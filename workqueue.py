@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import sharding
+
+TIMEOUT = 1800                               #seconds without heartbeat after which a claimed block is given to another worker
+POLL = 10                                    #seconds between checks while the last blocks are still running elsewhere
+
+# A queue is a folder on the shared file system:
+#   blocks        event ranges of block N on line N
+#   claimed/N     block N is being processed by the worker written inside, which touches the file while it works
+#   done/N        the output of block N is complete
+# A block is claimed by creating claimed/N exclusively, which works across machines without any lock server.
+
+def create(queue, blocks):
+    """new queue with the blocks of events, each a list of ranges [first, last)"""
+    tmp = queue.rstrip(os.sep) + '.tmp'
+    for sub in ('claimed', 'done'):
+        os.makedirs(os.path.join(tmp, sub))
+    with open(os.path.join(tmp, 'blocks'), 'w') as f:
+        f.write(''.join(sharding.format_events(ranges) + '\n' for ranges in blocks))
+    os.rename(tmp, queue)                    #workers never see a half written queue
+
+def read_blocks(queue):
+    with open(os.path.join(queue, 'blocks')) as f:
+        return [sharding.parse_events(line) for line in f.read().splitlines()]
+
+def worker_name():
+    return socket.gethostname() + '-' + str(os.getpid())
+
+def claim_path(queue, block):
+    return os.path.join(queue, 'claimed', str(block))
+
+def listed(queue, sub):
+    return {int(name) for name in os.listdir(os.path.join(queue, sub)) if name.isdigit()}
+
+def fs_time(queue, worker):
+    """current time of the shared file system, which the modification times of the claims refer to"""
+    fname = os.path.join(queue, 'clock.' + worker)
+    with open(fname, 'w'):
+        pass
+    now = os.stat(fname).st_mtime
+    os.remove(fname)
+    return now
+
+def reclaim(queue, worker, timeout=TIMEOUT):
+    """frees the blocks whose worker stopped touching them for timeout seconds (job killed, pre-empted or lost)"""
+    now = fs_time(queue, worker)
+    for block in listed(queue, 'claimed'):
+        path = claim_path(queue, block)
+        stale = path + '.stale.' + worker
+        try:
+            if now - os.stat(path).st_mtime < timeout:
+                continue
+            os.rename(path, stale)           #only one worker wins the rename
+        except FileNotFoundError:
+            continue
+        os.remove(stale)
+        print('Block', block, 'reclaimed after', timeout, 'seconds without heartbeat')
+
+def claim(queue, worker, nblocks, timeout=TIMEOUT):
+    """claims the first free block; None if every block is done or claimed"""
+    reclaim(queue, worker, timeout)
+    busy = listed(queue, 'done') | listed(queue, 'claimed')
+    for block in range(nblocks):
+        if block in busy:
+            continue
+        try:
+            fd = os.open(claim_path(queue, block), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:              #claimed by another worker in the meantime
+            continue
+        os.write(fd, worker.encode())
+        os.close(fd)
+        if os.path.exists(os.path.join(queue, 'done', str(block))):        #finished by a worker whose claim was reclaimed
+            os.remove(claim_path(queue, block))
+            continue
+        return block
+    return None
+
+def owner(queue, block):
+    try:
+        with open(claim_path(queue, block)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def release(queue, block, worker, done):
+    """marks the block done, or gives it back to the queue"""
+    if done:
+        open(os.path.join(queue, 'done', str(block)), 'w').close()
+    if owner(queue, block) == worker:
+        os.remove(claim_path(queue, block))
+
+class Heartbeat(threading.Thread):
+    """touches the claim of a block every interval seconds, until stopped"""
+
+    def __init__(self, queue, block, worker, interval):
+        super().__init__(daemon=True)
+        self.path = claim_path(queue, block)
+        self.queue, self.block, self.worker, self.interval = queue, block, worker, interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if owner(self.queue, self.block) != self.worker:        #reclaimed: the block may be computed twice, with the same result
+                return
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+def blocks(queue, worker, timeout=TIMEOUT, poll=POLL):
+    """claims the blocks of the queue one at a time until all of them are done, yielding (block number, event ranges).
+       A block is marked done when the next one is requested, and given back if the caller stops before."""
+    ranges = read_blocks(queue)
+    while True:
+        block = claim(queue, worker, len(ranges), timeout)
+        if block is None:
+            if len(listed(queue, 'done')) == len(ranges):
+                return
+            time.sleep(poll)                 #the last blocks are running elsewhere, and may still be reclaimed
+            continue
+        heartbeat = Heartbeat(queue, block, worker, timeout / 4)
+        heartbeat.start()
+        done = False
+        try:
+            yield block, ranges[block]
+            done = True
+        finally:
+            heartbeat.stop()
+            release(queue, block, worker, done)
+
+def status(queue):
+    nblocks = len(read_blocks(queue))
+    done = listed(queue, 'done')
+    claimed = listed(queue, 'claimed') - done
+    return {'blocks': nblocks, 'done': len(done), 'claimed': len(claimed), 'free': nblocks - len(done) - len(claimed)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Work queue of blocks of events, drained by splitted_fast_resp.py --queue')
+    parser.add_argument('command', choices=['create', 'status'])
+    parser.add_argument('queue', help='queue folder, on a file system shared by the workers')
+    parser.add_argument('-s', '--start', type=int, default=0, help='create: first event (default: 0)')
+    parser.add_argument('-e', '--events', type=int, help='create: number of events')
+    parser.add_argument('-b', '--block', type=int, default=10, help='create: events per block (default: 10)')
+    args = parser.parse_args()
+
+    if args.command == 'create':
+        if args.events is None:
+            sys.exit('-e is needed to create a queue')
+        stop = args.start + args.events
+        create(args.queue, [[(first, min(first + args.block, stop))] for first in range(args.start, stop, args.block)])
+    print('Blocks: %(blocks)d, done %(done)d, claimed %(claimed)d, free %(free)d' % status(args.queue))